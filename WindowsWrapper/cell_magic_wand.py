@@ -18,12 +18,33 @@
 #        point.  Other parameters set as optional arguments.
 #        Returns a binary mask with 1s inside the detected edge and
 #        a list of points along the detected edge.
+#        cell_magic_wand_window() and cell_magic_wand_batch() return
+#        masks cropped to the detected ROI, for one or many seed points.
+#        cell_magic_wand_3d() can run z slices in a pool of processes.
+#        Edge following uses a numba compiled kernel when numba is
+#        installed and NumPy otherwise, see EDGE_BACKEND.
+#        Run this file to compare the speed of the backends.
 #
 ###########################################################################
 
+import time
 import numpy as np
-from scipy.ndimage.interpolation import zoom
+from collections import OrderedDict
+from scipy.ndimage.interpolation import zoom, map_coordinates
 from scipy.ndimage.morphology import binary_fill_holes
+from parallel import run_tasks
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# most recently used polar offset tables, see polar_offset_table
+POLAR_OFFSET_CACHE_SIZE = 16
+_polar_offset_cache = OrderedDict()
+
+# pixels around interpolated points that zoomed windows read from, enough for
+# the spline prefilter of a window to match that of the whole image
+ZOOM_MARGIN = 24
 
 
 def coord_polar_to_cart(r, theta, center):
@@ -40,114 +61,252 @@ def coord_cart_to_polar(x, y, center):
     return r, theta
 
 
+def polar_offset_table(min_radius, max_radius, phase_width):
+    '''Returns (offsets_x, offsets_y, rounded_x, rounded_y, half_way) for the
+    (radius, phase) grid used by the wand, where offsets_* are Cartesian offsets
+    from the center and rounded_* their rounded integer values. For integer centers
+    rounded offsets plus center equal rounded coordinates, except for offsets
+    with fractional part about 0.5, which are flagged in half_way.
+    Tables are kept for the POLAR_OFFSET_CACHE_SIZE most recently used grids'''
+    key = (min_radius, max_radius, phase_width)
+    if key in _polar_offset_cache:
+        table = _polar_offset_cache.pop(key)
+    else:
+        theta, r = np.meshgrid(np.linspace(0, 2*np.pi, phase_width),
+                               np.arange(min_radius, max_radius))
+        offsets_x, offsets_y = coord_polar_to_cart(r, theta, (0, 0))
+        rounded_x, rounded_y = np.round(offsets_x).astype(int), np.round(offsets_y).astype(int)
+        half_way = np.logical_or(np.abs(np.abs(offsets_x - rounded_x) - 0.5) < 1e-6,
+                                 np.abs(np.abs(offsets_y - rounded_y) - 0.5) < 1e-6)
+        table = (offsets_x, offsets_y, rounded_x, rounded_y, half_way)
+    _polar_offset_cache[key] = table
+    while len(_polar_offset_cache) > POLAR_OFFSET_CACHE_SIZE:
+        _polar_offset_cache.popitem(last=False)
+    return table
+
+
+def polar_to_cart_indices(center, min_radius, max_radius, phase_width):
+    '''Returns rounded integer Cartesian coordinates of the (radius, phase) grid
+    around center. center coordinates may be arrays with dimensions (seed, 1, 1),
+    giving coordinates with dimensions (seed, radius, phase)'''
+    offsets_x, offsets_y, rounded_x, rounded_y, half_way = polar_offset_table(min_radius, max_radius, phase_width)
+    center_x, center_y = np.asarray(center[0]), np.asarray(center[1])
+    if np.any(center_x != np.round(center_x)) or np.any(center_y != np.round(center_y)):
+        x, y = offsets_x + center_x, offsets_y + center_y
+        return np.round(x).astype(int), np.round(y).astype(int)
+    x = rounded_x + center_x.astype(int)
+    y = rounded_y + center_y.astype(int)
+    if np.any(half_way):
+        # round the exact sums where rounding offsets first could break ties differently
+        if center_x.ndim > 0:
+            center_x, center_y = center_x[..., 0], center_y[..., 0]
+        x[..., half_way] = np.round(offsets_x[half_way] + center_x)
+        y[..., half_way] = np.round(offsets_y[half_way] + center_y)
+    return x, y
+
+
+def polar_pad_dist(center, max_radius, shape):
+    '''Returns zero padding image_cart_to_polar needs so that all samples
+    within max_radius of center lie inside an image of argument shape.
+    Padding is rounded up, as samples at radius floor(max_radius) can lie
+    up to one pixel beyond the fractional part of max_radius'''
+    return np.ceil(np.max([np.zeros(np.shape(center[0])), (center[0] + max_radius) - shape[0], -(center[0] - max_radius),
+                           (center[1] + max_radius) - shape[1], -(center[1] - max_radius)], axis=0)).astype(int)
+
+
+def padded_indices(x, y, pad_dist, shape):
+    '''Maps indices into an image of argument shape zero padded by pad_dist back to
+    image indices. x and y are not shifted by the padding, so negative indices wrap
+    around the padded image. Returns image indices and a mask of those inside the image'''
+    x = np.where(x < 0, x + shape[0] + 2*pad_dist, x) - pad_dist
+    y = np.where(y < 0, y + shape[1] + 2*pad_dist, y) - pad_dist
+    inside = (x >= 0) & (x < shape[0]) & (y >= 0) & (y < shape[1])
+    return x, y, inside
+
+
+def gather_padded(image, x, y, pad_dist):
+    '''Returns np.pad(image, pad_dist, 'constant')[x, y] without padding the image'''
+    if np.all(pad_dist == 0):
+        return image[x, y]
+    x, y, inside = padded_indices(x, y, pad_dist, image.shape)
+    values = np.zeros(x.shape, dtype=image.dtype)
+    values[inside] = image[x[inside], y[inside]]
+    return values
+
+
+def zoom_values(image, zoom_factor, x, y, corner=(0, 0), input_shape=None):
+    '''Returns values of zoom(full_image, (zoom_factor, zoom_factor), order=4) at output
+    pixels (x, y), where image holds the pixels of full_image from corner onwards and
+    full_image has input_shape. Only image pixels within ZOOM_MARGIN of the points are read'''
+    if input_shape is None:
+        input_shape = image.shape
+    output_shape = [int(round(n * zoom_factor)) for n in input_shape]
+    ratio = [(i - 1) / float(o - 1) if o > 1 else 1.0 for i, o in zip(input_shape, output_shape)]
+    x, y = x * ratio[0] - corner[0], y * ratio[1] - corner[1]
+    x0, x1 = max(int(np.floor(x.min())) - ZOOM_MARGIN, 0), min(int(np.ceil(x.max())) + ZOOM_MARGIN + 1, image.shape[0])
+    y0, y1 = max(int(np.floor(y.min())) - ZOOM_MARGIN, 0), min(int(np.ceil(y.max())) + ZOOM_MARGIN + 1, image.shape[1])
+    return map_coordinates(image[x0:x1, y0:y1], [x - x0, y - y0], order=4, output=image.dtype)
+
+
 def image_cart_to_polar(image, center, min_radius, max_radius, phase_width, zoom_factor=1):
     '''Converts an image from cartesian to polar coordinates around center'''
 
-    # Upsample image
+    # Upsample image, interpolating only near center
+    shape = image.shape
     if zoom_factor != 1:
-        image = zoom(image, (zoom_factor, zoom_factor), order=4)
+        shape = tuple([int(round(n * zoom_factor)) for n in image.shape])
         center = (center[0]*zoom_factor + zoom_factor/2, center[1]*zoom_factor + zoom_factor/2)
         min_radius = min_radius * zoom_factor
         max_radius = max_radius * zoom_factor
     
-    # pad if necessary
-    max_x, max_y = image.shape[0], image.shape[1]
-    pad_dist_x = np.max([(center[0] + max_radius) - max_x, -(center[0] - max_radius)])
-    pad_dist_y = np.max([(center[1] + max_radius) - max_y, -(center[1] - max_radius)])
-    pad_dist = int(np.max([0, pad_dist_x, pad_dist_y]))
-    if pad_dist != 0:
-        image = np.pad(image, pad_dist, 'constant')
-
-    # coordinate conversion
-    theta, r = np.meshgrid(np.linspace(0, 2*np.pi, phase_width),
-                           np.arange(min_radius, max_radius))
-    x, y = coord_polar_to_cart(r, theta, center)
-    x, y = np.round(x), np.round(y)
-    x, y = x.astype(int), y.astype(int)
-    
-    polar = image[x, y]
-    polar.reshape((max_radius - min_radius, phase_width))
+    # coordinate conversion, padding with zeros if necessary
+    x, y = polar_to_cart_indices(center, min_radius, max_radius, phase_width)
+    pad_dist = polar_pad_dist(center, max_radius, shape)
+    if zoom_factor == 1:
+        return gather_padded(image, x, y, pad_dist)
+    x, y, inside = padded_indices(x, y, pad_dist, shape)
+    polar = np.zeros(x.shape, dtype=image.dtype)
+    if np.any(inside):
+        polar[inside] = zoom_values(image, zoom_factor, x[inside], y[inside])
 
     return polar
 
 
-def mask_polar_to_cart(mask, center, min_radius, max_radius, output_shape, zoom_factor=1):
-    '''Converts a polar binary mask to Cartesian and places in an image of zeros'''
+def mask_polar_to_window(mask, center, min_radius, max_radius, output_shape, zoom_factor=1):
+    '''Converts a polar binary mask to Cartesian within a window around the mask.
+    Returns the filled mask cropped to its nonzero pixels plus a 1 pixel margin
+    and the (0th, 1th) image coordinates of its corner'''
 
     # Account for upsampling 
+    shape = output_shape
+    margin = 1
     if zoom_factor != 1:
         center = (center[0]*zoom_factor + zoom_factor/2, center[1]*zoom_factor + zoom_factor/2)
         min_radius = min_radius * zoom_factor
         max_radius = max_radius * zoom_factor
-        output_shape = map(lambda a: a * zoom_factor, output_shape)
-
-    # new image
-    image = np.zeros(output_shape)
-
-    # coordinate conversion
-    theta, r = np.meshgrid(np.linspace(0, 2*np.pi, mask.shape[1]),
-                           np.arange(0, max_radius))
-    x, y = coord_polar_to_cart(r, theta, center)
-    x, y = np.round(x), np.round(y)
-    x, y = x.astype(int), y.astype(int)
-
-    x = np.clip(x, 0, image.shape[0]-1)
-    y = np.clip(y, 0, image.shape[1]-1)
-    ix,iy = np.meshgrid(np.arange(0,mask.shape[1]), np.arange(0,mask.shape[0]))    
-    image[x,y] = mask
-
-    # downsample image
+        shape = map(lambda a: a * zoom_factor, output_shape)
+        margin = ZOOM_MARGIN
+
+    # coordinate conversion, drawing into a window of zeros around the mask
+    x, y = polar_to_cart_indices(center, 0, max_radius, mask.shape[1])
+    x = np.clip(x, 0, shape[0]-1)
+    y = np.clip(y, 0, shape[1]-1)
+    x0, x1 = max(x.min() - margin, 0), min(x.max() + margin + 1, shape[0])
+    y0, y1 = max(y.min() - margin, 0), min(y.max() + margin + 1, shape[1])
+    window = np.zeros((x1 - x0, y1 - y0))
+    window[x - x0, y - y0] = mask
+
+    # downsample window, only output pixels near the mask can exceed 0.5
     if zoom_factor != 1:
         zf = 1/float(zoom_factor)
-        image = zoom(image, (zf, zf), order=4)
+        downsampled_shape = [int(round(n * zf)) for n in shape]
+        ratio = [(n - 1) / float(d - 1) if d > 1 else 1.0 for n, d in zip(shape, downsampled_shape)]
+        ox0, ox1 = max(int(np.floor((x.min() - 3) / ratio[0])), 0), min(int(np.ceil((x.max() + 3) / ratio[0])) + 1, downsampled_shape[0])
+        oy0, oy1 = max(int(np.floor((y.min() - 3) / ratio[1])), 0), min(int(np.ceil((y.max() + 3) / ratio[1])) + 1, downsampled_shape[1])
+        ox, oy = np.meshgrid(np.arange(ox0, ox1), np.arange(oy0, oy1), indexing='ij')
+        window = zoom_values(window, zf, ox.ravel(), oy.ravel(), (x0, y0), shape).reshape(ox.shape)
+        x0, y0 = ox0, oy0
 
     # ensure image remains a filled binary mask
-    image = (image > 0.5).astype(int)
-    image = binary_fill_holes(image)
-    return image
+    window = binary_fill_holes(window > 0.5)
+    return crop_mask(window, (x0, y0))
+
+
+def mask_polar_to_cart(mask, center, min_radius, max_radius, output_shape, zoom_factor=1):
+    '''Converts a polar binary mask to Cartesian and places in an image of zeros'''
+    window, corner = mask_polar_to_window(mask, center, min_radius, max_radius,
+                                          output_shape, zoom_factor=zoom_factor)
+    return uncrop_mask(window, corner, output_shape)
     
 
-def find_edge_2d(polar, min_radius):
+def edge_directions(polar):
+    '''Dynamic programming phase of edge finding for polar images in the last two
+    dimensions (radius, phase). Returns the move from each pixel to the next phase,
+    1 for awayright, 0 for right and -1 for closeright with ties preferring
+    awayright over right over closeright, and the best move values of the first phase'''
+    right = polar.copy()
+    right[..., :-1] += polar[..., 1:]
+    closeright = polar.copy()
+    closeright[..., 1:, :-1] += polar[..., :-1, 1:]
+    awayright = polar.copy()
+    awayright[..., :-1, :-1] += polar[..., 1:, 1:]
+    directions = np.where((awayright >= right) & (awayright >= closeright), 1,
+                          np.where(right >= closeright, 0, -1)).astype(np.int8)
+    start_values = np.maximum(np.maximum(awayright[..., 0], right[..., 0]), closeright[..., 0])
+    return directions, start_values
+
+
+def find_edge_radii_numpy(polar):
+    '''Edge radius index in each phase of a 2D polar image, following edge_directions
+    from the last maximum of the first phase if it is >= 0 and from radius 0 otherwise'''
+    directions, start_values = edge_directions(polar)
+    num_radii = polar.shape[0]
+    r = num_radii - 1 - np.argmax(start_values[::-1])
+    if start_values[r] < 0:
+        r = 0
+    radii = [r]
+    for column in directions.T[:-1].tolist():
+        r = min(max(r + column[r], 0), num_radii - 1)
+        radii.append(r)
+    return np.array(radii)
+
+
+if njit is not None:
+    @njit(cache=True)
+    def find_edge_radii_numba(polar):
+        '''find_edge_radii_numpy compiled by numba, computing only the moves along the edge'''
+        num_radii, num_phases = polar.shape
+        radii = np.zeros(num_phases, dtype=np.int64)
+        r = 0
+        r_max = 0.0
+        for i in range(num_radii):
+            value = polar[i, 0]
+            if num_phases > 1:
+                away, right, close = value, value + polar[i, 1], value
+                if i + 1 < num_radii:
+                    away = value + polar[i + 1, 1]
+                if i > 0:
+                    close = value + polar[i - 1, 1]
+                value = max(away, right, close)
+            if value >= r_max:
+                r, r_max = i, value
+        radii[0] = r
+        for t in range(1, num_phases):
+            value = polar[r, t - 1]
+            away, right, close = value, value + polar[r, t], value
+            if r + 1 < num_radii:
+                away = value + polar[r + 1, t]
+            if r > 0:
+                close = value + polar[r - 1, t]
+            if away >= right and away >= close:
+                r = min(r + 1, num_radii - 1)
+            elif right < close:
+                r = max(r - 1, 0)
+            radii[t] = r
+        return radii
+
+
+# functions returning edge radii of a 2D polar image, by backend name
+EDGE_BACKENDS = {'numpy': find_edge_radii_numpy}
+if njit is not None:
+    EDGE_BACKENDS['numba'] = find_edge_radii_numba
+
+# backend used by find_edge_2d and find_edge_batch
+EDGE_BACKEND = 'numba' if 'numba' in EDGE_BACKENDS else 'numpy'
+
+
+def find_edge_2d(polar, min_radius, backend=None):
     '''Dynamic programming algorithm to find edge given polar image'''
     if len(polar.shape) != 2:
         raise ValueError("argument to find_edge_2d must be 2D")
+    radii = EDGE_BACKENDS[backend or EDGE_BACKEND](polar)
 
-    # Dynamic programming phase
-    values_right_shift = np.pad(polar, ((0, 0), (0, 1)), 'constant', constant_values=0)[:, 1:]
-    values_closeright_shift = np.pad(polar, ((1, 0),(0, 1)), 'constant', constant_values=0)[:-1, 1:]
-    values_awayright_shift = np.pad(polar, ((0, 1), (0, 1)), 'constant', constant_values=0)[1:, 1:]
-
-    values_move = np.zeros((polar.shape[0], polar.shape[1], 3))
-    values_move[:, :, 2] = np.add(polar, values_closeright_shift)  # closeright
-    values_move[:, :, 1] = np.add(polar, values_right_shift)  # right
-    values_move[:, :, 0] = np.add(polar, values_awayright_shift)  # awayright
-    values = np.amax(values_move, axis=2)
-
-    directions = np.argmax(values_move, axis=2)
-    directions = np.subtract(directions, 1)
-    directions = np.negative(directions)
-        
-    # Edge following phase
-    edge = []
-    mask = np.zeros(polar.shape)
-    r_max, r = 0, 0
-    for i,v in enumerate(values[:,0]):
-        if v >= r_max:
-            r, r_max = i, v
-    edge.append((r+min_radius, 0))
-    mask[0:r+1, 0] = 1
-    for t in range(1,polar.shape[1]):
-        r += directions[r, t-1]
-        if r >= directions.shape[0]: r = directions.shape[0]-1
-        if r < 0: r = 0
-        edge.append((r+min_radius, t))
-        mask[0:r+1, t] = 1
-
-    # add to inside of mask accounting for min_radius
-    new_mask = np.ones((min_radius+mask.shape[0], mask.shape[1]))
-    new_mask[min_radius:, :] = mask
+    # edge points and mask inside them, accounting for min_radius
+    edge = np.column_stack((radii + min_radius, np.arange(polar.shape[1])))
+    new_mask = np.ones((min_radius+polar.shape[0], polar.shape[1]))
+    new_mask[min_radius:, :] = np.arange(polar.shape[0])[:, np.newaxis] <= radii
     
-    return np.array(edge), new_mask
+    return edge, new_mask
 
 
 def edge_polar_to_cart(edge, center):
@@ -166,6 +325,18 @@ def cell_magic_wand_single_point(image, center, min_radius, max_radius,
 
     Returns a binary mask with 1s inside the detected edge and
     a list of points along the detected edge.'''
+    mask, corner, cart_edge = cell_magic_wand_window(image, center, min_radius, max_radius,
+                                                     roughness=roughness, zoom_factor=zoom_factor)
+    return uncrop_mask(mask, corner, image.shape), cart_edge
+
+
+def cell_magic_wand_window(image, center, min_radius, max_radius,
+                           roughness=2, zoom_factor=1):
+    '''cell_magic_wand_single_point working only on a window of the image around center.
+
+    Returns the binary mask cropped to the detected ROI plus a 1 pixel margin,
+    the (0th, 1th) image coordinates of its corner and a list of points
+    along the detected edge.'''
     if roughness < 1:
         roughness = 1
         print "roughness must be >= 1, setting roughness to 1"
@@ -181,11 +352,102 @@ def cell_magic_wand_single_point(image, center, min_radius, max_radius,
     phase_width = int(2 * np.pi * max_radius * roughness)
     polar_image = image_cart_to_polar(image, center, min_radius, max_radius,
                                       phase_width=phase_width, zoom_factor=zoom_factor)
-    polar_edge, polar_mask = find_edge_2d(polar_image, min_radius)
+    polar_edge, polar_mask = find_edge_2d(polar_image, min_radius * zoom_factor)
     cart_edge = edge_polar_to_cart(polar_edge, center)
-    cart_mask = mask_polar_to_cart(polar_mask, center, min_radius, max_radius,
-                                   image.shape, zoom_factor=zoom_factor)
-    return cart_mask, cart_edge
+    cart_mask, corner = mask_polar_to_window(polar_mask, center, min_radius, max_radius,
+                                             image.shape, zoom_factor=zoom_factor)
+    return cart_mask, corner, cart_edge
+
+
+def find_edge_batch(polar, min_radius, backend=None):
+    '''find_edge_2d for a stack of polar images with dimensions (seed, radius, phase).
+    Returns edge radii with dimensions (seed, phase), where polar mask rows
+    with radius <= edge radius are inside the edge'''
+    if len(polar.shape) != 3:
+        raise ValueError("argument to find_edge_batch must be 3D")
+    num_seeds, num_radii, num_phases = polar.shape
+    if (backend or EDGE_BACKEND) != 'numpy':
+        edge = np.zeros((num_seeds, num_phases), dtype=int)
+        for i in range(num_seeds):
+            edge[i] = EDGE_BACKENDS[backend or EDGE_BACKEND](polar[i])
+        return edge + min_radius
+
+    # Edge following phase for all seeds together
+    directions, start_values = edge_directions(polar)
+    r = num_radii - 1 - np.argmax(start_values[:, ::-1], axis=1)
+    r[start_values.max(axis=1) < 0] = 0
+    edge = np.zeros((num_seeds, num_phases), dtype=int)
+    edge[:, 0] = r
+    seeds = np.arange(num_seeds)
+    for t in range(1, num_phases):
+        r = np.clip(r + directions[seeds, r, t-1], 0, num_radii-1)
+        edge[:, t] = r
+    return edge + min_radius
+
+
+def cell_magic_wand_batch(image, centers, min_radius, max_radius,
+                          roughness=2, zoom_factor=1):
+    '''Runs cell_magic_wand_single_point on every center in centers at once.
+
+    Polar samples of all centers are stacked and edge following steps all centers
+    together. Returns a list of binary masks, each cropped to its ROI plus a
+    1 pixel margin, and a list of (0th, 1th) image coordinates of mask corners'''
+    if zoom_factor != 1:
+        masks, corners = [], []
+        for c in centers:
+            mask, corner, _ = cell_magic_wand_window(image, c, min_radius, max_radius,
+                                                     roughness=roughness, zoom_factor=zoom_factor)
+            masks.append(mask)
+            corners.append(corner)
+        return masks, corners
+    if roughness < 1:
+        roughness = 1
+        print "roughness must be >= 1, setting roughness to 1"
+    if min_radius < 0:
+        min_radius = 0
+        print "min_radius must be >=0, setting min_radius to 0"
+    if max_radius <= min_radius:
+        max_radius = min_radius + 1
+        print "max_radius must be larger than min_radius, setting max_radius to " + str(max_radius)
+    if len(centers) == 0:
+        return [], []
+    phase_width = int(2 * np.pi * max_radius * roughness)
+    center_x = np.array([c[0] for c in centers], dtype=float)[:, np.newaxis, np.newaxis]
+    center_y = np.array([c[1] for c in centers], dtype=float)[:, np.newaxis, np.newaxis]
+
+    # polar samples as in image_cart_to_polar
+    x, y = polar_to_cart_indices((center_x, center_y), min_radius, max_radius, phase_width)
+    polar = gather_padded(image, x, y, polar_pad_dist((center_x, center_y), max_radius, image.shape))
+    edge = find_edge_batch(polar, min_radius)
+
+    # Cartesian masks drawn in a window around each ROI
+    r = np.arange(0, max_radius)[:, np.newaxis]
+    polar_masks = r[np.newaxis] <= edge[:, np.newaxis, :]
+    masks, corners = [], []
+    for i in range(len(centers)):
+        mask, corner = mask_polar_to_window(polar_masks[i], (center_x[i, 0, 0], center_y[i, 0, 0]),
+                                            min_radius, max_radius, image.shape)
+        masks.append(mask)
+        corners.append(corner)
+    return masks, corners
+
+
+def crop_mask(mask, corner=(0, 0)):
+    '''Crops binary mask to its nonzero pixels plus a 1 pixel margin.
+    Returns cropped mask and image coordinates of its corner'''
+    x, y = np.nonzero(mask)
+    if len(x) == 0:
+        return np.zeros((0, 0), dtype=bool), corner
+    x0, x1 = max(x.min() - 1, 0), min(x.max() + 2, mask.shape[0])
+    y0, y1 = max(y.min() - 1, 0), min(y.max() + 2, mask.shape[1])
+    return mask[x0:x1, y0:y1].astype(bool), (corner[0] + x0, corner[1] + y0)
+
+
+def uncrop_mask(mask, corner, shape):
+    '''Places cropped mask at corner of an image of zeros with argument shape'''
+    image = np.zeros(shape, dtype=bool)
+    image[corner[0]:corner[0]+mask.shape[0], corner[1]:corner[1]+mask.shape[1]] = mask
+    return image
 
 
 def cell_magic_wand(image, center, min_radius, max_radius,
@@ -194,32 +456,79 @@ def cell_magic_wand(image, center, min_radius, max_radius,
     combines the results for a more robust edge detection then provided by the vanilla wand tool.
 
     Returns a binary mask with 1s inside detected edge'''
-    
+    mask, corner = cell_magic_wand_robust_window(image, center, min_radius, max_radius,
+                                                 roughness=roughness, zoom_factor=zoom_factor,
+                                                 center_range=center_range)
+    return uncrop_mask(mask, corner, image.shape[:2]).astype(int)
+
+
+def cell_magic_wand_robust_window(image, center, min_radius, max_radius,
+                                  roughness=2, zoom_factor=1, center_range=2):
+    '''cell_magic_wand working only on a window of the image around center.
+    The nine jittered centers are sampled together by cell_magic_wand_batch and
+    pixels inside more than half of their masks are kept.
+
+    Returns the binary mask cropped to the detected ROI plus a 1 pixel margin
+    and the (0th, 1th) image coordinates of its corner'''
     centers = []
     for i in [-center_range, 0, center_range]:
         for j in [-center_range, 0, center_range]:
             centers.append((center[0]+i, center[1]+j))
-    masks = np.zeros((image.shape[0], image.shape[1], len(centers)))
-    for i, c in enumerate(centers):
-        mask, edge = cell_magic_wand_single_point(image, c, min_radius, max_radius,
-                                                  roughness=roughness, zoom_factor=zoom_factor)
-        masks[:,:,i] = mask
-    mean_mask = np.mean(masks, axis=2)
-    final_mask = (mean_mask > 0.5).astype(int)
-    return final_mask
+    masks, corners = cell_magic_wand_batch(image, centers, min_radius, max_radius,
+                                           roughness=roughness, zoom_factor=zoom_factor)
+    votes, corner = accumulate_votes(masks, corners)
+    return crop_mask(2 * votes > len(centers), corner)
+
+
+def accumulate_votes(masks, corners):
+    '''Counts how many of the cropped binary masks cover each pixel of the window
+    spanning all masks. Returns the counts and the (0th, 1th) image coordinates
+    of the window corner'''
+    windows = [(m, c) for m, c in zip(masks, corners) if m.size > 0]
+    if len(windows) == 0:
+        return np.zeros((0, 0), dtype=np.uint16), (0, 0)
+    x0 = min([c[0] for m, c in windows])
+    y0 = min([c[1] for m, c in windows])
+    x1 = max([c[0] + m.shape[0] for m, c in windows])
+    y1 = max([c[1] + m.shape[1] for m, c in windows])
+    votes = np.zeros((x1 - x0, y1 - y0), dtype=np.uint16)
+    for mask, corner in windows:
+        votes[corner[0]-x0:corner[0]-x0+mask.shape[0], corner[1]-y0:corner[1]-y0+mask.shape[1]] += mask
+    return votes, (x0, y0)
+
+
+def benchmark_edge_backends(num_radii=20, roughness=2, num_images=200, seed=0):
+    '''Times find_edge_2d with every available backend on random polar images
+    the size used for max_radius num_radii and checks that their results agree'''
+    num_phases = int(2 * np.pi * num_radii * roughness)
+    polars = np.random.RandomState(seed).rand(num_images, num_radii, num_phases)
+    results = {}
+    for backend in sorted(EDGE_BACKENDS):
+        find_edge_2d(polars[0], 0, backend=backend)  # compile before timing
+        start = time.time()
+        results[backend] = [find_edge_2d(polar, 0, backend=backend) for polar in polars]
+        print backend + ": %.1f us per image" % ((time.time() - start) / num_images * 1e6)
+    for backend in results:
+        for (edge, mask), (ref_edge, ref_mask) in zip(results[backend], results['numpy']):
+            if not (np.array_equal(edge, ref_edge) and np.array_equal(mask, ref_mask)):
+                raise AssertionError(backend + " and numpy edges differ")
+    print "backends agree on " + str(num_images) + " images"
 
 
 def cell_magic_wand_3d(image_3d, center, min_radius, max_radius,
-                       roughness=2, zoom_factor=1, center_range=2, z_step=1):
+                       roughness=2, zoom_factor=1, center_range=2, z_step=1, num_workers=1):
     '''Robust cell magic wand tool for 3D images with dimensions (z, x, y) - default for tifffile.load.
     This functions runs the robust wand tool on each z slice in the image and returns the mean mask
-    thresholded to 0.5'''
-    masks = np.zeros((int(image_3d.shape[0]/z_step), image_3d.shape[1], image_3d.shape[2]))
-    for s in range(int(image_3d.shape[0]/z_step)):
-        mask = cell_magic_wand(image_3d[s*z_step,:,:], center, min_radius, max_radius,
-                               roughness=roughness, zoom_factor=zoom_factor,
-                               center_range=center_range)
-        masks[s,:,:] = mask
-    mean_mask = np.mean(masks, axis=0)
-    final_mask = (mean_mask > 0.5).astype(int)
-    return final_mask
+    thresholded to 0.5. Slices are processed by num_workers processes'''
+    num_slices = int(image_3d.shape[0]/z_step)
+    tasks = [(image_3d[s*z_step,:,:], center, min_radius, max_radius, roughness, zoom_factor, center_range)
+             for s in range(num_slices)]
+    names = ['z slice ' + str(s*z_step) for s in range(num_slices)]
+    windows = run_tasks(cell_magic_wand_robust_window, tasks, num_workers, names)
+    votes, corner = accumulate_votes([w[0] for w in windows], [w[1] for w in windows])
+    mask, corner = crop_mask(2 * votes > num_slices, corner)
+    return uncrop_mask(mask, corner, image_3d.shape[1:3]).astype(int)
+
+
+if __name__ == "__main__":
+    benchmark_edge_backends()
@@ -11,34 +11,46 @@
 #   video = numpy array [frame #, width pixels, height pixels]
 #   ROI = binary numpy array [ROI #, width pixels, height pixels] 
 #         where 1-valued pixels are in ROI
+#         (or a compact RoiSet with the same shape if compact=True)
 #   also returns file_names list s.t. file_names[i] == name of data[i]
 #
 #  Usage: 
 #    import load
 #    data = load_data(directory, img_width=N, img_height=M) 
 #      # N,M is width and height of video frames in pixels 
+#    stk = open_stack(path)
+#      # frames are only read when indexed, e.g. stk[10:20]
+#    rois = load_rois(path, N, M, compact=True)
+#      # sparse ROI masks, see RoiSet
+#
+#  Rasterized ROI zips are cached in ROI_CACHE_DIR and reused
+#  until the zip file changes, see configure_roi_cache
 #
 ##################################################################
 
 import numpy as np
+from scipy import sparse
+import struct
 from PIL import Image, ImageDraw
 import tifffile
 import os 
 import os.path
+import hashlib
+import tempfile
+
+# on-disk cache of rasterized ROI zips, least recently used entries are
+# removed once the cache grows beyond ROI_CACHE_MAX_MB (<= 0 disables it)
+ROI_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.convnet_roi_cache')
+ROI_CACHE_MAX_MB = 256
+ROI_CACHE_VERSION = 1
 
 # load video and roi files from argument directory
-def load_data(directory, img_width, img_height, rois_only=False, no_rois=False):
+def load_data(directory, img_width, img_height, rois_only=False, no_rois=False, compact=False):
     assert(not (rois_only and no_rois))
     if directory[-1] != os.path.sep:
         directory += os.path.sep
 
-    file_names = []
-    for fn in os.listdir(directory):
-        file_base = os.path.basename(fn).rsplit(".")[0]
-        file_names.append(file_base)
-    file_names = set(file_names)
-    if '' in file_names:
-        file_names.remove('')
+    file_names = get_file_names(directory)
         
     stks = []
     rois = []
@@ -46,12 +58,12 @@ def load_data(directory, img_width, img_height, rois_only=False, no_rois=False):
         stack_name = directory+fn+'.tif'
         roi_name = directory+fn+'.zip'
         if rois_only:
-            rois.append(load_rois(roi_name, img_width, img_height))
+            rois.append(load_rois(roi_name, img_width, img_height, compact=compact))
         elif no_rois:
             stks.append(load_stack(stack_name))
         else:
             stks.append(load_stack(stack_name))
-            rois.append(load_rois(roi_name, img_width, img_height))
+            rois.append(load_rois(roi_name, img_width, img_height, compact=compact))
             #data.append((load_stack(stack_name), load_rois(roi_name, img_width, img_height)))
     if rois_only:
         return rois, list(file_names)
@@ -62,6 +74,15 @@ def load_data(directory, img_width, img_height, rois_only=False, no_rois=False):
     #return data, list(file_names)
 
 
+# directory -> sorted names of files in directory without extensions
+def get_file_names(directory):
+    file_names = set()
+    for fn in os.listdir(directory):
+        file_names.add(os.path.basename(fn).rsplit(".")[0])
+    file_names.discard('')
+    return sorted(file_names)
+
+
 # tif -> (frame #, width, height)
 def load_stack(path):
     with tifffile.TiffFile(path) as im:
@@ -80,18 +101,376 @@ def load_stack(path):
     return np.array(stk, dtype='float32')
 """
 
+# tif -> lazily read (frame #, width, height) stack
+def open_stack(path, dtype='float32'):
+    return LazyStack(path, dtype)
+
+
+class LazyStack:
+    '''Tif stack with dimensions (frame #, width, height) read on demand.
+
+    Uncompressed tifs are memory-mapped and compressed tifs are decoded page by page,
+    so indexing a frame range only reads those frames. Indexing follows numpy
+    semantics on the frame axis and returns arrays converted to dtype.'''
+
+    def __init__(self, path, dtype='float32'):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self._tif = tifffile.TiffFile(path)
+        self._memmap = None
+        self._data = None
+        series = self._tif.series[0]
+        # frames hold the Y and X axes and any axes after them, such as the
+        # samples of RGB tifs, so that shape matches load_stack
+        frame_start = series.axes.find('Y')
+        if frame_start < 0:
+            frame_start = max(len(series.shape) - 2, 0)
+        frame_shape = tuple(series.shape[frame_start:])
+        n_frames = int(np.prod(series.shape[:frame_start])) if frame_start > 0 else 1
+        self.shape = (n_frames,) + frame_shape
+        self._page_per_frame = len(series.pages) == n_frames
+        if series.offset is not None and series.pages[0].is_memmappable:
+            self._memmap = np.memmap(path, dtype=self._tif.byteorder + series.dtype.char,
+                                     mode='r', offset=series.offset, shape=self.shape)
+            self.close()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if self._memmap is not None:
+            return np.array(self._memmap[key], dtype=self.dtype)
+        frames = np.arange(self.shape[0])[key[0]]
+        if np.ndim(frames) == 0:
+            raw = self._read_frames([frames])[0][key[1:]]
+        else:
+            raw = self._read_frames(frames)[(slice(None),) + key[1:]]
+        return np.array(raw, dtype=self.dtype)
+
+    def __array__(self, dtype=None):
+        stk = self[:]
+        return stk if dtype is None else stk.astype(dtype)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _read_frames(self, frames):
+        '''returns raw data of listed frames without dtype conversion'''
+        frames = list(frames)
+        if len(frames) == 0:
+            return np.zeros((0,) + self.shape[1:], dtype=self.dtype)
+        if self._data is not None:
+            return self._data[frames]
+        if self._tif is None:
+            self._tif = tifffile.TiffFile(self.path)
+        if self._page_per_frame:
+            return self._tif.asarray(key=frames, series=0).reshape((-1,) + self.shape[1:])
+        # frames share pages, so the series has to be decoded at once
+        self._data = self._tif.series[0].asarray().reshape(self.shape)
+        self.close()
+        return self._data[frames]
+
+    def iter_chunks(self, chunk_size):
+        '''yields consecutive (frame #, width, height) chunks of at most chunk_size frames'''
+        for start in range(0, self.shape[0], chunk_size):
+            yield self[start:start + chunk_size]
+
+    def close(self):
+        '''closes the underlying tif file, which is reopened if more frames are read'''
+        if self._tif is not None:
+            self._tif.close()
+            self._tif = None
+
+
+# tif -> number of frames
+def stack_length(path):
+    with open_stack(path) as stk:
+        return len(stk)
+
+
+# tif -> generator of float32 (frame #, width, height) chunks of at most chunk_size frames
+def load_stack_chunks(path, chunk_size):
+    with open_stack(path) as stk:
+        for chunk in stk.iter_chunks(chunk_size):
+            yield chunk
+
+
 # roi zip -> (roi #, width, height)
-def load_rois(path, width, height, fill=1, xdisp=0, ydisp=0):
-    rois = read_roi_zip(open(path))
-    ret = []
-    for i,roi in enumerate(rois):
-        poly = []
-        for x in roi:
-            poly.append((x[1] + xdisp,x[0] + ydisp))
-        img = Image.new('L', (width, height), 0)
-        ImageDraw.Draw(img).polygon(poly, outline=1, fill=fill)
-        ret.append(np.array(img))
-    return np.array(ret,dtype='float32')
+def load_rois(path, width, height, fill=1, xdisp=0, ydisp=0, compact=False):
+    cache_path = roi_cache_path(path, (width, height, fill, xdisp, ydisp))
+    rois = read_roi_cache(cache_path)
+    if rois is None:
+        rois = rasterize_rois(read_roi_zip(path), width, height, fill, xdisp, ydisp)
+        write_roi_cache(cache_path, rois)
+    if compact:
+        return rois
+    return rois.dense()
+
+
+def configure_roi_cache(cfg_parser):
+    '''Sets ROI cache location and size from optional roi_cache_dir
+    and roi_cache_max_mb options in general section of configuration file.
+    Worker processes do not see these settings, see roi_cache_settings'''
+    cache_dir, max_mb = roi_cache_settings()
+    if cfg_parser.has_option('general', 'roi_cache_dir') and cfg_parser.get('general', 'roi_cache_dir').strip() != '':
+        cache_dir = cfg_parser.get('general', 'roi_cache_dir').strip()
+    if cfg_parser.has_option('general', 'roi_cache_max_mb'):
+        max_mb = cfg_parser.getfloat('general', 'roi_cache_max_mb')
+    set_roi_cache(cache_dir, max_mb)
+
+
+def roi_cache_settings():
+    '''Returns (cache directory, size limit in MB) of the ROI cache of this process.
+    Pass them to worker processes that load ROIs with initializer=set_roi_cache,
+    as workers started by spawn (e.g. on Windows) re-import this module with defaults'''
+    return ROI_CACHE_DIR, ROI_CACHE_MAX_MB
+
+
+def set_roi_cache(cache_dir, max_mb):
+    '''Sets ROI cache location and size limit in MB (<= 0 disables the cache)'''
+    global ROI_CACHE_DIR, ROI_CACHE_MAX_MB
+    ROI_CACHE_DIR = cache_dir
+    ROI_CACHE_MAX_MB = max_mb
+
+
+def roi_cache_path(path, params):
+    '''Returns cache file for roi zip at path rasterized with params, or None if
+    caching is disabled. Entries are keyed on absolute path, size and modification
+    time of the zip, so editing the zip makes its old entries unreachable'''
+    if ROI_CACHE_MAX_MB <= 0:
+        return None
+    stat = os.stat(path)
+    key = repr((ROI_CACHE_VERSION, os.path.normcase(os.path.abspath(path)),
+                stat.st_size, stat.st_mtime) + tuple(params))
+    return os.path.join(ROI_CACHE_DIR, hashlib.sha1(key).hexdigest() + '.npz')
+
+
+def read_roi_cache(cache_path):
+    '''Returns cached RoiSet or None if it is missing or unreadable'''
+    if cache_path is None or not os.path.isfile(cache_path):
+        return None
+    try:
+        rois = load_roi_npz(cache_path)
+        os.utime(cache_path, None)
+    except Exception:
+        # unreadable entries are removed so they can be rewritten
+        try:
+            os.remove(cache_path)
+        except OSError:
+            pass
+        return None
+    return rois
+
+
+def write_roi_cache(cache_path, rois):
+    '''Atomically stores RoiSet in cache and evicts least recently used entries.
+    Each writer renames its own temporary file into place, so concurrent processes
+    never see partial entries; failures only mean the entry is not cached'''
+    if cache_path is None:
+        return
+    try:
+        if not os.path.isdir(ROI_CACHE_DIR):
+            os.makedirs(ROI_CACHE_DIR)
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=ROI_CACHE_DIR)
+        with os.fdopen(fd, 'wb') as f:
+            rois.save(f)
+        try:
+            os.rename(tmp_path, cache_path)
+        except OSError:
+            # windows does not replace existing files, another process stored this entry
+            os.remove(tmp_path)
+    except (IOError, OSError):
+        return
+    evict_roi_cache()
+
+
+def evict_roi_cache():
+    '''Removes least recently used cache entries until cache fits in ROI_CACHE_MAX_MB'''
+    entries = []
+    for fn in os.listdir(ROI_CACHE_DIR):
+        if not fn.endswith('.npz'):
+            continue
+        try:
+            stat = os.stat(os.path.join(ROI_CACHE_DIR, fn))
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, fn))
+    total = sum(size for _, size, _ in entries)
+    for _, size, fn in sorted(entries):
+        if total <= ROI_CACHE_MAX_MB * 2**20:
+            break
+        try:
+            os.remove(os.path.join(ROI_CACHE_DIR, fn))
+        except OSError:
+            pass
+        total -= size
+
+
+# roi polygons -> RoiSet (roi #, width, height)
+def rasterize_rois(rois, width, height, fill=1, xdisp=0, ydisp=0):
+    '''draws each polygon only inside its bounding box, which gives
+    the same pixels as drawing on a full (width, height) image'''
+    indptr = [0]
+    indices = []
+    data = []
+    for roi in rois:
+        pixels = np.zeros(0, dtype=int)
+        values = np.zeros(0, dtype='uint8')
+        xs = roi[:,1] + xdisp
+        ys = roi[:,0] + ydisp
+        if len(roi) > 0:
+            x0, x1 = max(int(np.floor(xs.min())) - 1, 0), min(int(np.ceil(xs.max())) + 2, width)
+            y0, y1 = max(int(np.floor(ys.min())) - 1, 0), min(int(np.ceil(ys.max())) + 2, height)
+            if x0 < x1 and y0 < y1:
+                img = Image.new('L', (x1 - x0, y1 - y0), 0)
+                ImageDraw.Draw(img).polygon(zip(xs - x0, ys - y0), outline=1, fill=fill)
+                img = np.array(img)
+                y, x = np.nonzero(img)
+                pixels = (y + y0) * width + (x + x0)
+                values = img[y, x]
+        indices.append(pixels)
+        data.append(values)
+        indptr.append(indptr[-1] + len(pixels))
+    return roi_set_from_csr(data, indices, indptr, (height, width))
+
+
+# list of (width, height) masks -> RoiSet (roi #, width, height)
+def roi_set_from_masks(masks, frame_shape):
+    indptr = [0]
+    indices = []
+    data = []
+    for mask in masks:
+        mask = np.asarray(mask).ravel()
+        nonzero = np.flatnonzero(mask)
+        indices.append(nonzero)
+        data.append(mask[nonzero])
+        indptr.append(indptr[-1] + len(nonzero))
+    return roi_set_from_csr(data, indices, indptr, frame_shape)
+
+
+# list of cropped masks and (0th, 1th) corners -> RoiSet (roi #, width, height)
+def roi_set_from_crops(masks, corners, frame_shape):
+    indptr = [0]
+    indices = []
+    data = []
+    for mask, (x0, y0) in zip(masks, corners):
+        mask = np.asarray(mask)
+        x, y = np.nonzero(mask)
+        indices.append((x + x0) * frame_shape[1] + (y + y0))
+        data.append(mask[x, y])
+        indptr.append(indptr[-1] + len(x))
+    return roi_set_from_csr(data, indices, indptr, frame_shape)
+
+
+def roi_set_from_csr(data, indices, indptr, frame_shape):
+    '''builds RoiSet from per-ROI lists of flat pixel indices and values'''
+    data = np.concatenate([np.zeros(0, dtype='float32')] + list(data)).astype('float32')
+    indices = np.concatenate([np.zeros(0, dtype='int32')] + list(indices)).astype('int32')
+    masks = sparse.csr_matrix((data, indices, np.array(indptr, dtype='int32')),
+                              shape=(len(indptr) - 1, frame_shape[0] * frame_shape[1]))
+    return RoiSet(masks, frame_shape)
+
+
+# (roi #, width, height) array or RoiSet -> RoiSet
+def as_roi_set(rois):
+    if isinstance(rois, RoiSet):
+        return rois
+    rois = np.asarray(rois)
+    return RoiSet(sparse.csr_matrix(rois.reshape(rois.shape[0], -1), dtype='float32'), rois.shape[1:])
+
+
+# npz with compact or dense 'rois' -> RoiSet
+def load_roi_npz(path):
+    with np.load(path) as f:
+        if 'roi_indptr' in f:
+            masks = sparse.csr_matrix((f['roi_data'], f['roi_indices'], f['roi_indptr']),
+                                      shape=(len(f['roi_indptr']) - 1, int(np.prod(f['roi_shape'][1:]))))
+            return RoiSet(masks, f['roi_shape'][1:])
+        return as_roi_set(f['rois'])
+
+
+class RoiSet:
+    '''ROI masks with dimensions (roi #, width, height) stored as a sparse matrix.
+
+    Row i of the CSR matrix self.masks holds the nonzero pixels of ROI i in flattened
+    (width, height) order, so memory grows with ROI area rather than image area.
+    Integer indexing returns the dense mask of one ROI, and slice or list indexing
+    returns a new RoiSet. Dense stacks are only built by dense() or numpy conversion.'''
+
+    def __init__(self, masks, frame_shape):
+        self.masks = sparse.csr_matrix(masks, dtype='float32')
+        self.masks.eliminate_zeros()
+        self.frame_shape = tuple(int(d) for d in frame_shape)
+        self.shape = (self.masks.shape[0],) + self.frame_shape
+        assert(self.masks.shape[1] == self.frame_shape[0] * self.frame_shape[1])
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, long, np.integer)):
+            return self.mask(key)
+        return RoiSet(self.masks[key], self.frame_shape)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.mask(i)
+
+    def __array__(self, dtype=None):
+        return self.dense() if dtype is None else self.dense(dtype)
+
+    def mask(self, i):
+        '''dense (width, height) mask of ROI i'''
+        return self.masks[i].toarray().reshape(self.frame_shape)
+
+    def dense(self, dtype='float32'):
+        '''dense (roi #, width, height) array'''
+        return self.masks.toarray().astype(dtype).reshape(self.shape)
+
+    def areas(self):
+        '''number of pixels in each ROI'''
+        return np.diff(self.masks.indptr)
+
+    def bboxes(self):
+        '''(roi #, 4) array of [min 0th, min 1th, max 0th + 1, max 1th + 1]
+        pixel bounds of each ROI, all 0 for empty ROIs'''
+        bboxes = np.zeros((len(self), 4), dtype=int)
+        nonempty = self.areas() > 0
+        if not np.any(nonempty):
+            return bboxes
+        starts = self.masks.indptr[:-1][nonempty]
+        x, y = np.divmod(self.masks.indices, self.frame_shape[1])
+        bboxes[nonempty, 0] = np.minimum.reduceat(x, starts)
+        bboxes[nonempty, 1] = np.minimum.reduceat(y, starts)
+        bboxes[nonempty, 2] = np.maximum.reduceat(x, starts) + 1
+        bboxes[nonempty, 3] = np.maximum.reduceat(y, starts) + 1
+        return bboxes
+
+    def max_projection(self):
+        '''(width, height) maximum over all ROIs, e.g. a binary image of all ROI pixels'''
+        projection = np.zeros(self.frame_shape[0] * self.frame_shape[1], dtype='float32')
+        np.maximum.at(projection, self.masks.indices, self.masks.data)
+        return projection.reshape(self.frame_shape)
+
+    def label_image(self):
+        '''(width, height) image with value i + 1 on pixels of ROI i and 0 elsewhere.
+        Pixels shared by several ROIs get the highest ROI index'''
+        labels = np.zeros(self.frame_shape[0] * self.frame_shape[1], dtype='int32')
+        labels[self.masks.indices] = np.repeat(np.arange(1, len(self) + 1), self.areas())
+        return labels.reshape(self.frame_shape)
+
+    def is_binary(self):
+        return bool(np.all(self.masks.data == 1))
+
+    def save(self, path, **arrays):
+        '''saves ROIs and any extra arrays to compressed npz, see load_roi_npz'''
+        np.savez_compressed(path, roi_indptr=self.masks.indptr, roi_indices=self.masks.indices,
+                            roi_data=self.masks.data, roi_shape=np.array(self.shape), **arrays)
 
 ###########################################################
 # read_roi function 
@@ -122,37 +501,18 @@ def read_roi(fileobj):
     DRAW_OFFSET = 256
 
 
-    pos = [4]
-    def get8():
-        pos[0] += 1
-        s = fileobj.read(1)
-        if not s:
-            raise IOError('readroi: Unexpected EOF')
-        return ord(s)
-
-    def get16():
-        b0 = get8()
-        b1 = get8()
-        return (b0 << 8) | b1
+    HEADER = struct.Struct('>4sHBxHHHHHffffHIIIHHBBHII')
 
-    def get32():
-        s0 = get16()
-        s1 = get16()
-        return (s0 << 16) | s1
+    data = fileobj.read()
+    if len(data) < HEADER.size:
+        raise IOError('readroi: Unexpected EOF')
+    (magic, version, roi_type, top, left, bottom, right, n_coordinates,
+     x1, y1, x2, y2, stroke_width, shape_roi_size, stroke_color, fill_color,
+     subtype, options, arrow_style, arrow_head_size, rect_arc_size,
+     position, header2offset) = HEADER.unpack_from(data)
 
-    def getfloat():
-        v = np.int32(get32())
-        return v.view(np.float32)
-
-    magic = fileobj.read(4)
     if magic != 'Iout':
         raise IOError('Magic number not found')
-    version = get16()
-
-    # It seems that the roi type field occupies 2 Bytes, but only one is used
-    roi_type = get8()
-    # Discard second Byte:
-    get8()
 
     if not (0 <= roi_type < 11):
         raise ValueError('roireader: ROI type %s not supported' % roi_type)
@@ -160,40 +520,27 @@ def read_roi(fileobj):
     #if roi_type != 7:
     #    raise ValueError('roireader: ROI type %s not supported (!= 7)' % roi_type)
 
-    top = get16()
-    left = get16()
-    bottom = get16()
-    right = get16()
-    n_coordinates = get16()
-
-    x1 = getfloat() 
-    y1 = getfloat() 
-    x2 = getfloat() 
-    y2 = getfloat()
-    stroke_width = get16()
-    shape_roi_size = get32()
-    stroke_color = get32()
-    fill_color = get32()
-    subtype = get16()
     if subtype != 0:
         raise ValueError('roireader: ROI subtype %s not supported (!= 0)' % subtype)
-    options = get16()
-    arrow_style = get8()
-    arrow_head_size = get8()
-    rect_arc_size = get16()
-    position = get32()
-    header2offset = get32()
 
+    # integer coordinates are relative to (left, top); sub-pixel coordinates
+    # follow them as absolute float32 values
+    coords_start = HEADER.size
     if options & SUB_PIXEL_RESOLUTION:
-        getc = getfloat
+        coords_start += 4 * n_coordinates
+        dtype = np.dtype('>f4')
         points = np.empty((n_coordinates, 2), dtype=np.float32)
     else:
-        getc = get16
+        dtype = np.dtype('>i2')
         points = np.empty((n_coordinates, 2), dtype=np.int16)
-    points[:,1] = [getc() for i in xrange(n_coordinates)]
-    points[:,0] = [getc() for i in xrange(n_coordinates)]
-    points[:,1] += left
-    points[:,0] += top
+    if len(data) < coords_start + 2 * n_coordinates * dtype.itemsize:
+        raise IOError('readroi: Unexpected EOF')
+    coords = np.frombuffer(data, dtype=dtype, count=2 * n_coordinates, offset=coords_start)
+    points[:,1] = coords[:n_coordinates]
+    points[:,0] = coords[n_coordinates:]
+    if not options & SUB_PIXEL_RESOLUTION:
+        points[:,1] += left
+        points[:,0] += top
     points -= 1
     return points
 
@@ -0,0 +1,101 @@
+###########################################################
+#
+# Process pool helpers for independent per-file work
+#
+# Description: runs a function over a list of argument
+#   tuples in a pool of worker processes, returning
+#   results in input order and reporting failures
+#   per task instead of aborting the whole run
+#
+# Usage: results = run_tasks(func, tasks, num_workers, names)
+#          where tasks is a list of argument tuples for func
+#          and func is defined at module level (picklable)
+#        Large inputs common to all tasks are passed once per
+#          worker with initializer=share_data and read by
+#          tasks with shared_data(name)
+#
+###########################################################
+
+import multiprocessing
+import traceback
+
+# data shared by all tasks run in this process, see share_data
+_shared_data = {}
+
+
+def get_num_workers(cfg_parser, section, default=1):
+    '''Reads num_workers from section of configuration file.
+    Values < 1 mean one worker per CPU core'''
+    if not cfg_parser.has_option(section, 'num_workers'):
+        return default
+    num_workers = cfg_parser.getint(section, 'num_workers')
+    if num_workers < 1:
+        return multiprocessing.cpu_count()
+    return num_workers
+
+
+def share_data(data):
+    '''Pool initializer storing a dict of data for the tasks of a worker.
+    Worker processes receive it once when they start, not with every task'''
+    _shared_data.clear()
+    _shared_data.update(data)
+
+
+def shared_data(name):
+    '''Returns an item stored by share_data in this process'''
+    return _shared_data[name]
+
+
+def _run_task(func_task):
+    '''calls func with task arguments, catching any exception as a traceback string'''
+    func, task = func_task
+    try:
+        return func(*task), None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+def map_tasks(func, tasks, num_workers=1, initializer=None, initargs=()):
+    '''Applies func to each argument tuple in tasks using num_workers processes.
+    Yields (result, error) pairs in task order, where error is the
+    traceback of a failed task or None. initializer(*initargs) is called
+    in every worker before its first task. When tasks run in this process,
+    data stored by share_data is released once they finish'''
+    func_tasks = [(func, tuple(task)) for task in tasks]
+    if num_workers <= 1 or len(func_tasks) <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        try:
+            for func_task in func_tasks:
+                yield _run_task(func_task)
+        finally:
+            if initializer is not None:
+                _shared_data.clear()
+        return
+    pool = multiprocessing.Pool(min(num_workers, len(func_tasks)), initializer, initargs)
+    try:
+        for result in pool.imap(_run_task, func_tasks):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def run_tasks(func, tasks, num_workers=1, names=None, initializer=None, initargs=()):
+    '''Runs func on every task and returns results in task order.
+    Errors are printed per task and a RuntimeError naming all
+    failed tasks is raised once every task has finished'''
+    tasks = list(tasks)
+    if names is None:
+        names = [str(task) for task in tasks]
+    results = []
+    failed = []
+    for name, (result, error) in zip(names, map_tasks(func, tasks, num_workers, initializer, initargs)):
+        if error is not None:
+            print "Error processing " + name + ":\n" + error
+            failed.append(name)
+        results.append(result)
+    if len(failed) > 0:
+        raise RuntimeError("Processing failed for " + ", ".join(failed))
+    return results
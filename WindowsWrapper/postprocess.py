@@ -24,9 +24,10 @@ import cPickle as pickle
 import ConfigParser
 import tifffile
 from load import *
-from score import Score
+from score import GroundTruthIndex
 from preprocess import is_labeled, add_pathsep, get_labeled_split, split_labeled_directory
-from cell_magic_wand import cell_magic_wand, cell_magic_wand_single_point
+from cell_magic_wand import cell_magic_wand, cell_magic_wand_single_point, cell_magic_wand_batch
+from parallel import run_tasks, get_num_workers, share_data, shared_data
 
 
 def read_network_output(directory):
@@ -48,16 +49,15 @@ def read_preprocessed_images(directory, filenames):
     '''reads and correlates preprocessed images
     input to ZNN with filenames read by read_network_output'''
     directory = add_pathsep(directory)
+    files = [f for f in os.listdir(directory) if os.path.isfile(directory + f)]
     images = []
     for fname in filenames:
         found = False
-        for f in os.listdir(directory):
-            if not os.path.isfile(directory + f): continue
+        for f in files:
             base = os.path.splitext(f)[0]
             if base in fname:
-               im = Image.open(directory + f)
-               im = np.array(im, dtype=np.float32)
-               images.append(im)
+               with open_stack(directory + f) as stk:
+                   images.append(stk[0])
                found = True
                break
         if not found:
@@ -65,21 +65,125 @@ def read_preprocessed_images(directory, filenames):
     return images
 
 
+class PostprocessData:
+    '''Network output probability maps and the preprocessed images they were
+    computed from, read once and matched by filename so that postprocessing
+    and scoring can be repeated with different parameters'''
+
+    def __init__(self, preprocess_dir, network_output_dir):
+        self.network_images, self.filenames = read_network_output(network_output_dir)
+        self.preprocessed_images = read_preprocessed_images(preprocess_dir, self.filenames)
+        self.ground_truth_rois = None
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def load_ground_truth(self, data_dir, img_width, img_height):
+        '''Reads ground truth ROIs of the images from labeled data_dir'''
+        ground_truth_rois, filenames = load_data(data_dir, img_width, img_height, rois_only=True, compact=True)
+        self.ground_truth_rois = self.align(ground_truth_rois, filenames)
+
+    def shared(self):
+        '''Returns the images and ground truth as data for parallel.share_data'''
+        return {'network_images':self.network_images,
+                'preprocessed_images':self.preprocessed_images,
+                'filenames':self.filenames,
+                'ground_truth_rois':self.ground_truth_rois}
+
+    def align(self, items, filenames):
+        '''Reorders items named by filenames, e.g. ground truth ROIs returned
+        by load_data, to the order of the images'''
+        positions = dict([(f, i) for i, f in enumerate(filenames)])
+        missing = [f for f in self.filenames if f not in positions]
+        if len(missing) > 0:
+            raise ValueError("Couldn't find " + ", ".join(missing) + " in " + str(filenames))
+        return [items[positions[f]] for f in self.filenames]
+
+
+def unique_in_set_order(image):
+    '''returns unique values of image and flat indices of their first occurrences,
+    ordered as iteration over set(image.flatten()). A set only changes when a new
+    value is added, so adding unique values by first occurrence builds the same set'''
+    values, first = np.unique(image, return_index=True)
+    by_occurrence = np.argsort(first)
+    values, first = values[by_occurrence], first[by_occurrence]
+    position = dict(zip(values.tolist(), range(len(values))))
+    order = [position[v] for v in set(values.tolist())]
+    return values[order], first[order]
+
+
 def watershed_centroids(labels):
     '''finds centroids of watershed regions'''
     new_markers = np.zeros(labels.shape)
-    for label in set(labels.flatten()):
-        cx,cy = np.where(labels == label)
-        cx,cy = int(cx.mean()), int(cy.mean()) 
-        new_markers[cx,cy] = label
+    values, _ = unique_in_set_order(labels)
+    flat_labels = labels.ravel()
+    cx, cy = np.indices(labels.shape)
+    counts = np.bincount(flat_labels)[values]
+    cx = (np.bincount(flat_labels, weights=cx.ravel())[values] / counts).astype(int)
+    cy = (np.bincount(flat_labels, weights=cy.ravel())[values] / counts).astype(int)
+    # where centroids coincide the label written last wins
+    _, last = np.unique((cx * labels.shape[1] + cy)[::-1], return_index=True)
+    last = len(values) - 1 - last
+    new_markers[cx[last], cy[last]] = values[last]
     return new_markers
 
 
+class ThresholdComponents:
+    '''Connected components of a probability map thresholded at any number of levels.
+    Components at a higher threshold are nested in components at lower thresholds,
+    so a component is identified at every level by its first pixel and its size.
+    Thresholded masks after removing small objects are then identified by the
+    components they keep, without comparing pixels'''
+
+    def __init__(self, im):
+        self.im = im
+        self.levels = {}
+
+    def level(self, threshold):
+        '''Returns component labels of im > threshold, component sizes and flat
+        indices of first pixels by label, computing them once per threshold'''
+        if threshold not in self.levels:
+            labels = ndi.label(self.im > threshold)[0]
+            sizes = np.bincount(labels.ravel())
+            first = np.zeros(len(sizes), dtype=int)
+            values, indices = np.unique(labels, return_index=True)
+            first[values] = indices
+            self.levels[threshold] = (labels, sizes, first)
+        return self.levels[threshold]
+
+    def key(self, threshold, min_size):
+        '''Returns a key that is equal for (threshold, min_size) pairs with equal masks'''
+        labels, sizes, first = self.level(threshold)
+        keep = sizes >= min_size
+        keep[0] = False
+        return tuple(sorted(zip(first[keep].tolist(), sizes[keep].tolist())))
+
+    def mask(self, threshold, min_size):
+        '''Returns remove_small_objects(im > threshold, min_size)'''
+        labels, sizes, first = self.level(threshold)
+        keep = sizes >= min_size
+        keep[0] = False
+        return keep[labels]
+
+
 def find_neuron_centers(im, threshold, min_size, merge_size, max_footprint=(7,7)):
     '''finds putative centers of neurons by thresholding and 
     watershedding with a distance transform'''
     t = im > threshold
     t = remove_small_objects(t, min_size)
+    return watershed_neuron_centers(im, t, merge_size, max_footprint)
+
+
+def watershed_neuron_centers(im, t, merge_size, max_footprint=(7,7)):
+    '''finds putative centers of neurons in thresholded mask t of im
+    by watershedding with a distance transform'''
+    p, labels, markers = watershed_regions(im, t, max_footprint)
+    return merge_small_regions(p, t, markers, small_regions(labels, merge_size))
+
+
+def watershed_regions(im, t, max_footprint=(7,7)):
+    '''First watershed of watershed_neuron_centers, which does not depend on merge_size.
+    Returns the watershed surface, region labels and region centroid markers'''
     c = im.copy()
     c[np.logical_not(t)] = 0
     if c.max() != c.min():
@@ -91,11 +195,21 @@ def find_neuron_centers(im, threshold, min_size, merge_size, max_footprint=(7,7)
     local_max = peak_local_max(p, indices=False, footprint=np.ones(max_footprint), labels=t)
     markers = ndi.label(local_max)[0]
     labels = watershed(-p, markers, mask=t)
-    markers = watershed_centroids(labels)
-    for i in set(labels.flatten()):
-        if i == 0: continue
-        if np.sum(labels==i) < merge_size:
-            markers[markers==i] = 0
+    return p, labels, watershed_centroids(labels)
+
+
+def small_regions(labels, merge_size):
+    '''Returns labels of watershed regions with fewer than merge_size pixels'''
+    sizes = np.bincount(labels.ravel())
+    small = np.flatnonzero(sizes < merge_size)
+    return small[small != 0]
+
+
+def merge_small_regions(p, t, markers, small):
+    '''Watersheds surface p within mask t again without the markers of regions
+    labeled small, merging them into their neighbours. Returns new markers and labels'''
+    markers = markers.copy()
+    markers[np.in1d(markers, small).reshape(markers.shape)] = 0
     labels = watershed(-p, markers, mask=t)
     markers = watershed_centroids(labels)
     return markers, labels
@@ -104,61 +218,241 @@ def find_neuron_centers(im, threshold, min_size, merge_size, max_footprint=(7,7)
 def markers_to_seeds(markers, border_0th, border_1th):
     '''converts watershed markers to seed points for magic wand'''
     centers = []
-    for m in set(markers.flatten()):
+    values, first = unique_in_set_order(markers)
+    for m, x, y in zip(values, *np.unravel_index(first, markers.shape)):
         if m == 0: continue
-        x,y = np.where(markers == m)
-        x = x[0] + border_0th
-        y = y[0] + border_1th
+        x = x + border_0th
+        y = y + border_1th
         centers.append((x,y))
     return centers
 
 
+def find_seeds(network_image, image_shape, threshold, min_size_watershed, merge_size_watershed, max_footprint):
+    '''Finds neuron centers in a network output probability map and returns them as
+    magic wand seed points of the preprocessed image with argument shape'''
+    markers, labels = find_neuron_centers(network_image, threshold, min_size_watershed, merge_size_watershed, max_footprint=max_footprint)
+    return image_seeds(markers, image_shape)
+
+
+def image_seeds(markers, image_shape):
+    '''markers_to_seeds for markers of a network output image centered in the
+    preprocessed image with argument shape'''
+    size_diff_0th = image_shape[0] - markers.shape[0]
+    size_diff_1th = image_shape[1] - markers.shape[1]
+    return markers_to_seeds(markers, size_diff_0th/2, size_diff_1th/2)
+
+
+def pad_network_image(network_image, image_shape):
+    '''Pads network output with zeros to the argument shape of the preprocessed image'''
+    size_diff_0th = image_shape[0] - network_image.shape[0]
+    size_diff_1th = image_shape[1] - network_image.shape[1]
+    return np.pad(network_image, ((int(np.floor(size_diff_0th/2.0)), int(np.ceil(size_diff_0th/2.0))),
+                                  (int(np.floor(size_diff_1th/2.0)), int(np.ceil(size_diff_1th/2.0)))), 'constant')
+
+
+def wand_rois(preprocessed_image, padded_network_image, seeds, min_size_wand, max_size_wand):
+    '''Runs magic wand cell edge detection from each seed. Returns cropped masks,
+    their corners and their mean network output probabilities'''
+    masks, corners = cell_magic_wand_batch(preprocessed_image, seeds, min_size_wand, max_size_wand)
+    roi_probs = []
+    for mask, (x0, y0) in zip(masks, corners):
+        probs = padded_network_image[x0:x0+mask.shape[0], y0:y0+mask.shape[1]]
+        roi_probs.append(np.sum(np.multiply(mask, probs))/np.sum(mask))
+    return masks, corners, roi_probs
+
+
+def crops_to_roi_set(masks, corners, shape):
+    '''RoiSet of cropped masks, holding a single empty ROI if there are no masks'''
+    if len(masks) == 0:
+        return roi_set_from_masks([np.zeros(shape)], shape)
+    return roi_set_from_crops(masks, corners, shape)
+
+
+def postprocess_image(network_image, preprocessed_image, filename,
+                      threshold, min_size_watershed, merge_size_watershed, max_footprint,
+                      min_size_wand, max_size_wand):
+    '''Postprocesses the network output of one image with argument parameters.
+    Returns ROIs and their mean network output probabilities'''
+    seeds = find_seeds(network_image, preprocessed_image.shape, threshold,
+                       min_size_watershed, merge_size_watershed, max_footprint)
+    print "Running magic wand for " + filename
+    masks, corners, roi_probs = wand_rois(preprocessed_image, pad_network_image(network_image, preprocessed_image.shape),
+                                          seeds, min_size_wand, max_size_wand)
+    return crops_to_roi_set(masks, corners, preprocessed_image.shape), roi_probs
+
+
+def postprocess_image_grid(network_image, preprocessed_image, filename, param_grid):
+    '''postprocess_image for every tuple of its parameters in param_grid. The first
+    watershed runs once per (thresholded mask, max_footprint), where masks of
+    (threshold, min_size_watershed) pairs keeping the same components are shared.
+    Seeds are found once per first watershed and set of regions smaller than
+    merge_size_watershed, and the wand runs once per (seed, min_size_wand, max_size_wand).
+    Returns a list of (ROIs, probabilities) in param_grid order'''
+    print "Running grid search for " + filename
+    padded_network_image = pad_network_image(network_image, preprocessed_image.shape)
+    components = ThresholdComponents(network_image)
+    regions_memo = {}
+    seeds_memo = {}
+    wand_memo = {}
+    results = []
+    for params in param_grid:
+        threshold, min_size_watershed, merge_size_watershed, max_footprint = params[:4]
+        wand_params = tuple(params[4:])
+        regions_key = (components.key(threshold, min_size_watershed), tuple(max_footprint))
+        if regions_key not in regions_memo:
+            t = components.mask(threshold, min_size_watershed)
+            regions_memo[regions_key] = (t,) + watershed_regions(network_image, t, max_footprint)
+        t, p, labels, markers = regions_memo[regions_key]
+        small = small_regions(labels, merge_size_watershed)
+        watershed_key = (regions_key, tuple(small))
+        if watershed_key not in seeds_memo:
+            markers, labels = merge_small_regions(p, t, markers, small)
+            seeds_memo[watershed_key] = image_seeds(markers, preprocessed_image.shape)
+        seeds = seeds_memo[watershed_key]
+        new_seeds = [s for s in seeds if (s,) + wand_params not in wand_memo]
+        masks, corners, roi_probs = wand_rois(preprocessed_image, padded_network_image, new_seeds, *wand_params)
+        for s, wand in zip(new_seeds, zip(masks, corners, roi_probs)):
+            wand_memo[(s,) + wand_params] = wand
+        wands = [wand_memo[(s,) + wand_params] for s in seeds]
+        masks = [mask for mask, corner, prob in wands]
+        corners = [corner for mask, corner, prob in wands]
+        roi_probs = [prob for mask, corner, prob in wands]
+        results.append((crops_to_roi_set(masks, corners, preprocessed_image.shape), roi_probs))
+    return results
+
+
+def postprocess_shared_image(i, *params):
+    '''postprocess_image for the ith image shared with this process by postprocessing'''
+    return postprocess_image(shared_data('network_images')[i], shared_data('preprocessed_images')[i],
+                             shared_data('filenames')[i], *params)
+
+
+def score_shared_image_grid(i, param_grid):
+    '''postprocess_image_grid for the ith image shared with this process.
+    Returns the F1 score of the ROIs found with each parameter tuple'''
+    results = postprocess_image_grid(shared_data('network_images')[i], shared_data('preprocessed_images')[i],
+                                     shared_data('filenames')[i], param_grid)
+    ground_truth = GroundTruthIndex([shared_data('ground_truth_rois')[i]])
+    return list(ground_truth.score_batch([[rois] for rois, roi_probs in results])["f1_scores"][:, 0])
+
+
+def score_param_grid(data, param_grid, image_indices, num_workers=1, scores=None):
+    '''Scores every parameter tuple in param_grid by the mean F1 score of the images
+    of PostprocessData data at image_indices, as Score.total_f1_score. F1 scores of
+    single images are looked up in and added to scores, a dict keyed by
+    (image index, parameters), so that no image is postprocessed twice
+    with the same parameters'''
+    if scores is None:
+        scores = {}
+    tasks = [(i, [params for params in param_grid if (i, params) not in scores]) for i in image_indices]
+    tasks = [(i, params) for i, params in tasks if len(params) > 0]
+    results = run_tasks(score_shared_image_grid, tasks, num_workers, [data.filenames[i] for i, params in tasks],
+                        initializer=share_data, initargs=(data.shared(),))
+    for (i, params), f1_scores in zip(tasks, results):
+        scores.update(zip([(i, p) for p in params], f1_scores))
+    mean_scores = []
+    for params in param_grid:
+        threshold, min_size_watershed, merge_size_watershed, max_footprint, min_size_wand, max_size_wand = params
+        print "Testing threshold: " + str(threshold) + " min_size_watershed: " + str(min_size_watershed) + " max_footprint: " + str(max_footprint[0]) + " max_size_wand: " + str(max_size_wand)
+        mean_scores.append(np.mean([scores[(i, params)] for i in image_indices]))
+        print "F1 score: " + str(mean_scores[-1])
+    return mean_scores
+
+
+def exhaustive_search(param_grid, evaluate, image_order):
+    '''Scores every parameter tuple in param_grid with evaluate(param_grid, image_indices)
+    on all images. Returns (score, parameters) pairs'''
+    return zip(evaluate(param_grid, image_order), param_grid)
+
+
+def successive_halving(param_grid, evaluate, image_order, factor=3):
+    '''Scores parameter tuples in param_grid with evaluate(param_grid, image_indices) on
+    growing prefixes of image_order, keeping the best 1/factor of them after each round
+    until the remaining ones are scored on all images. Returns (score, parameters) pairs
+    of the final round. Rounds are limited so that each one scores more images than the last'''
+    if factor < 2:
+        raise ValueError('halving factor should be at least 2', factor)
+    candidates = list(param_grid)
+    num_rounds = max(1, int(np.ceil(np.log(len(candidates)) / np.log(factor))))
+    num_rounds = min(num_rounds, 1 + int(np.floor(np.log(max(1, len(image_order))) / np.log(factor) + 1e-9)))
+    for k in range(num_rounds):
+        num_images = max(1, int(np.ceil(len(image_order) * float(factor) ** (k + 1 - num_rounds))))
+        print "Successive halving round " + str(k + 1) + ": " + str(len(candidates)) + " candidates on " + str(num_images) + " images"
+        scores = evaluate(candidates, image_order[:num_images])
+        if k < num_rounds - 1:
+            best = np.argsort(-np.array(scores), kind='mergesort')[:int(np.ceil(len(candidates) / float(factor)))]
+            candidates = [candidates[j] for j in sorted(best)]
+    return zip(scores, candidates)
+
+
+def halton(index, base):
+    '''index-th element (index >= 1) of the Halton sequence in prime base'''
+    result, f = 0.0, 1.0
+    while index > 0:
+        f /= base
+        result += f * (index % base)
+        index //= base
+    return result
+
+
+def sample_params(ranges, budget, sampling='random', seed=0):
+    '''Returns budget points in the box spanned by a list of (min, max) ranges,
+    drawn uniformly at random or from the Halton sequence with sampling 'halton' '''
+    primes = [2, 3, 5, 7, 11, 13]
+    rng = np.random.RandomState(seed)
+    points = []
+    for k in range(budget):
+        if sampling == 'halton':
+            u = [halton(k + 1, primes[d]) for d in range(len(ranges))]
+        else:
+            u = rng.rand(len(ranges))
+        points.append([low + u_d * (high - low) for u_d, (low, high) in zip(u, ranges)])
+    return points
+
+
 def postprocessing(preprocess_dir, network_output_dir, postprocess_dir, 
                    threshold, min_size_watershed, merge_size_watershed, max_footprint, 
-                   min_size_wand, max_size_wand):
+                   min_size_wand, max_size_wand, num_workers=1, data=None):
     '''Performs postprocessing with argument parameters. Returns ROIs 
-    and associated filenames'''
-    # convert probability maps into neuron centers
-    network_images, filenames = read_network_output(network_output_dir)
-    preprocessed_images = read_preprocessed_images(preprocess_dir, filenames)
-    markers, labels = zip(*[find_neuron_centers(im, threshold, min_size_watershed, merge_size_watershed, max_footprint=max_footprint) for im in network_images])
-
-    # run magic wand cell edge detection
-    all_rois = []
-    all_roi_probs = []
-    for i in range(len(network_images)):
-        print "Running magic wand for " + filenames[i]
-        size_diff_0th = preprocessed_images[i].shape[0] - network_images[i].shape[0]
-        size_diff_1th = preprocessed_images[i].shape[1] - network_images[i].shape[1]
-        padded_network_image = np.pad(network_images[i], ((int(np.floor(size_diff_0th/2.0)), int(np.ceil(size_diff_0th/2.0))),
-                                                          (int(np.floor(size_diff_1th/2.0)), int(np.ceil(size_diff_1th/2.0)))), 'constant')
-        seeds = markers_to_seeds(markers[i], size_diff_0th/2, size_diff_1th/2)
-        rois = []
-        roi_probs = []
-        for j,c in enumerate(seeds):
-            print str(j) + "/" + str(len(seeds)-1)
-            roi,_ = cell_magic_wand_single_point(preprocessed_images[i], c, min_size_wand, max_size_wand)
-            roi_prob = np.sum(np.multiply(roi, padded_network_image))/np.sum(roi)
-            rois.append(roi)
-            roi_probs.append(roi_prob)
-
-        if len(rois) == 0:
-            rois.append(np.zeros(preprocessed_images[i].shape))
-            
-        rois = np.array(rois)
-        all_rois.append(rois)
-        all_roi_probs.append(roi_probs)
-    return all_rois, all_roi_probs, filenames        
+    and associated filenames. Images are read from the directories unless
+    already loaded PostprocessData is given. Images are processed by num_workers
+    processes, which receive the images once each rather than with every task'''
+    if data is None:
+        data = PostprocessData(preprocess_dir, network_output_dir)
+    tasks = [(i, threshold, min_size_watershed, merge_size_watershed, max_footprint,
+              min_size_wand, max_size_wand) for i in range(len(data))]
+    results = run_tasks(postprocess_shared_image, tasks, num_workers, data.filenames,
+                        initializer=share_data, initargs=(data.shared(),))
+    all_rois = [rois for rois, roi_probs in results]
+    all_roi_probs = [roi_probs for rois, roi_probs in results]
+    return all_rois, all_roi_probs, data.filenames        
 
 
 def parameter_optimization(data_dir, preprocess_dir, network_output_dir, postprocess_dir,
                            min_size_wand, max_size_wand, img_width, img_height,
-                           params_cfg_fn, cfg_parser):
-    '''Performs grid search optimization of postprocessing parameters and stores result in
-    new configuration file'''
+                           params_cfg_fn, cfg_parser, data=None, num_workers=None):
+    '''Performs optimization of postprocessing parameters and stores result in
+    new configuration file. Images are read once, or taken from PostprocessData data.
+    Candidates are scored by num_workers processes, read from cfg_parser if None.
 
-    # get ground truth ROIs
-    ground_truth_rois, filenames = load_data(data_dir, img_width, img_height, rois_only=True)
+    The search option of the postprocessing optimization section selects
+    exhaustive grid search, successive halving over the grid ('halving') or
+    search_budget points drawn from the parameter ranges ('random' or 'halton')'''
+
+    # get images and ground truth ROIs in the same order
+    if data is None:
+        data = PostprocessData(preprocess_dir, network_output_dir)
+    data.load_ground_truth(data_dir, img_width, img_height)
+    if num_workers is None:
+        num_workers = get_num_workers(cfg_parser, 'postprocessing')
+    search = 'exhaustive'
+    if cfg_parser.has_option('postprocessing optimization', 'search'):
+        search = cfg_parser.get('postprocessing optimization', 'search').strip()
+    if search not in ['exhaustive', 'halving', 'random', 'halton']:
+        raise ValueError('search should be one of "exhaustive", "halving", "random" or "halton"', search)
+    seed = 0
+    if cfg_parser.has_option('postprocessing optimization', 'search_seed'):
+        seed = cfg_parser.getint('postprocessing optimization', 'search_seed')
     
     # get ranges for grid search
     min_threshold = cfg_parser.getfloat('postprocessing optimization', 'min_threshold')
@@ -175,34 +469,54 @@ def parameter_optimization(data_dir, preprocess_dir, network_output_dir, postpro
     # make ranges for grid search
     threshold_range = np.linspace(min_threshold, max_threshold, steps_threshold)
     min_size_watershed_range = np.linspace(min_minsize, max_minsize, steps_minsize)
-    max_footprint_range = np.linspace(min_footprint, max_footprint, steps_footprint)
+    max_footprint_range = np.linspace(min_footprint, max_footprint, steps_footprint).astype(int)
     if steps_wand < 2:
         max_size_wand_range = np.array([max_size_wand])
     else:
-        max_size_wand_range = np.linspace(min_size_wand+1, max_size_wand, steps_wand)
+        max_size_wand_range = np.unique(np.round(np.linspace(min_size_wand+1, max_size_wand, steps_wand)).astype(int))
 
-    # run grid search and save scores
-    scores_params = []
-    for threshold, min_size_watershed, max_footprint, max_size_wand in itertools.product(threshold_range, min_size_watershed_range, max_footprint_range, max_size_wand_range):
+    # make candidate parameters, searching a range only if it has more than one step
+    if search in ['random', 'halton']:
+        ranges = [(min_threshold, max_threshold if steps_threshold > 1 else min_threshold),
+                  (min_minsize, max_minsize if steps_minsize > 1 else min_minsize),
+                  (min_footprint, max_footprint if steps_footprint > 1 else min_footprint),
+                  (max_size_wand_range[0], max_size_wand_range[-1])]
+        budget = cfg_parser.getint('postprocessing optimization', 'search_budget')
+        points = [(threshold, min_size_watershed, int(round(max_footprint)), int(round(max_size_wand)))
+                  for threshold, min_size_watershed, max_footprint, max_size_wand
+                  in sample_params(ranges, budget, search, seed)]
+    else:
+        points = itertools.product(threshold_range, min_size_watershed_range, max_footprint_range, max_size_wand_range)
+    param_grid = []
+    for threshold, min_size_watershed, max_footprint, max_size_wand in points:
         merge_size_watershed = min_size_watershed
-        print "Testing threshold: " + str(threshold) + " min_size_watershed: " + str(min_size_watershed) + " max_footprint: " + str(max_footprint) + " max_size_wand: " + str(max_size_wand)
-        rois, roi_probs, filenames = postprocessing(preprocess_dir, network_output_dir,
-                                                    postprocess_dir, threshold, 
-                                                    min_size_watershed, merge_size_watershed,
-                                                    (max_footprint,max_footprint),
-                                                    min_size_wand, max_size_wand)
-        s = Score(ground_truth_rois, rois)
-        print "F1 score: " + str(s.total_f1_score)
-        scores_params.append((s.total_f1_score, {'probability_threshold':threshold,
-                                                 'min_size_watershed':min_size_watershed, 
-                                                 'merge_size_watershed':merge_size_watershed,
-                                                 'max_footprint':(max_footprint, max_footprint),
-                                                 'max_size_wand':max_size_wand}))
+        param_grid.append((threshold, min_size_watershed, merge_size_watershed,
+                           (max_footprint, max_footprint), min_size_wand, max_size_wand))
+
+    # run search, postprocessing each image for all candidates at once so that
+    # watershed and wand results shared by candidates are reused
+    scores = {}
+    evaluate = lambda params, image_indices: score_param_grid(data, params, image_indices, num_workers, scores)
+    if search == 'halving':
+        factor = 3
+        if cfg_parser.has_option('postprocessing optimization', 'halving_factor'):
+            factor = cfg_parser.getint('postprocessing optimization', 'halving_factor')
+        image_order = list(np.random.RandomState(seed).permutation(len(data)))
+        results = successive_halving(param_grid, evaluate, image_order, factor)
+    else:
+        results = exhaustive_search(param_grid, evaluate, range(len(data)))
+    scores_params = []
+    for score, (threshold, min_size_watershed, merge_size_watershed, max_footprint,
+                min_size_wand, max_size_wand) in results:
+        scores_params.append((score, {'probability_threshold':threshold,
+                                      'min_size_watershed':min_size_watershed, 
+                                      'merge_size_watershed':merge_size_watershed,
+                                      'max_footprint':max_footprint,
+                                      'max_size_wand':max_size_wand}))
 
     # find best score and save corresponding parameters
-    scores_params.sort()
-    best_params = scores_params[-1][1]
-    print "Best F1 score: " + str(scores_params[-1][0])
+    best_score, best_params = max(scores_params)
+    print "Best F1 score: " + str(best_score)
     params_cfg_parser = ConfigParser.SafeConfigParser()
     params_cfg_parser.add_section("postprocessing")
     for param in best_params:
@@ -212,8 +526,9 @@ def parameter_optimization(data_dir, preprocess_dir, network_output_dir, postpro
     return params_cfg_parser
         
 
-def main(main_config_fpath='../data/example/main_config.cfg'):
-    '''Get user-specified information from main_config.cfg'''
+def main(main_config_fpath='../data/example/main_config.cfg', num_workers=None):
+    '''Get user-specified information from main_config.cfg. Images are
+    processed by num_workers processes, read from main_config.cfg if None'''
     cfg_parser = ConfigParser.SafeConfigParser()
     cfg_parser.readfp(open(main_config_fpath,'r'))
     
@@ -241,24 +556,32 @@ def main(main_config_fpath='../data/example/main_config.cfg'):
     # get non-optimized postprocessing parameters
     img_width = cfg_parser.getint('general','img_width')
     img_height = cfg_parser.getint('general', 'img_height')
+    configure_roi_cache(cfg_parser)
     do_gridsearch_postprocess_params = cfg_parser.getboolean('general', 'do_gridsearch_postprocess_params')
     min_size_wand = cfg_parser.getfloat('postprocessing', 'min_size_wand')
     max_size_wand = cfg_parser.getfloat('postprocessing', 'max_size_wand')
+    if num_workers is None:
+        num_workers = get_num_workers(cfg_parser, 'postprocessing')
     
-    # locate optimized postprocessing parameters or run grid search optimization
+    # locate optimized postprocessing parameters or run grid search optimization,
+    # keeping images it reads for the final postprocessing run
+    datasets = {}
     params_cfg_parser = ConfigParser.SafeConfigParser()
     opt_params_cfg_fn = parent_dir + "optimized_postprocess_params.cfg"
     if do_gridsearch_postprocess_params and os.path.isfile(opt_params_cfg_fn):
         params_cfg_parser.readfp(open(opt_params_cfg_fn, 'r'))
     elif (do_gridsearch_postprocess_params and
           not os.path.isfile(opt_params_cfg_fn) and is_labeled(data_dir)):
+        datasets[ttv_list[1]] = PostprocessData(preprocess_dir + ttv_list[1],
+                                                network_output_dir + ttv_list[1])
         params_cfg_parser = parameter_optimization(data_dir + ttv_list[1],
                                                    preprocess_dir + ttv_list[1],
                                                    network_output_dir + ttv_list[1],
                                                    postprocess_dir + ttv_list[1],
                                                    min_size_wand,
                                                    max_size_wand, img_width, img_height,
-                                                   opt_params_cfg_fn, cfg_parser)
+                                                   opt_params_cfg_fn, cfg_parser,
+                                                   datasets[ttv_list[1]], num_workers)
     else:
         params_cfg_parser = cfg_parser
          
@@ -276,15 +599,21 @@ def main(main_config_fpath='../data/example/main_config.cfg'):
         final_rois, final_roi_probs, filenames = postprocessing(preprocess_dir + ttv, network_output_dir + ttv, 
                                                postprocess_dir + ttv, threshold, 
                                                min_size_watershed, merge_size_watershed,
-                                               max_footprint, min_size_wand, max_size_wand)
+                                               max_footprint, min_size_wand, max_size_wand,
+                                               num_workers, datasets.pop(ttv, None))
     
         # Save final ROIs
         for i,roi in enumerate(final_rois):
-            r = roi.max(axis=0)
+            r = roi.max_projection()
             roi_name = postprocess_dir + ttv + filenames[i] + '.tif'
             tifffile.imsave(roi_name, r.astype(np.float32))
-            np.savez_compressed(postprocess_dir + ttv + filenames[i] + '.npz', rois=roi, roi_probabilities=final_roi_probs[i])
+            roi.save(postprocess_dir + ttv + filenames[i] + '.npz', roi_probabilities=final_roi_probs[i])
 
             
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 2:
+        main(sys.argv[1], int(sys.argv[2]))
+    elif len(sys.argv) > 1:
+        main(sys.argv[1])
+    else:
+        main()
@@ -10,24 +10,55 @@
 # Usage: Call main() function with path to
 #   configuration file to downsample,
 #   time equalize, improve contrast,
-#   and find centroids.
+#   and find centroids in a single pass
+#   over each video.
+#   python preprocess.py <config file path> [num_workers]
 #
 ###################################################
 
 import sys
 import shutil
+import hashlib
+import json
 import numpy as np
 import skimage.io
 import os.path
-from load import load_data, load_stack
+from load import (load_stack, load_rois, load_stack_chunks, stack_length, configure_roi_cache,
+                  roi_cache_settings, set_roi_cache)
+from parallel import run_tasks, get_num_workers
 import tifffile
 from PIL import Image
 import ConfigParser
 from scipy.ndimage import zoom
 
 
-def improve_contrast(stks, upper_contrast, lower_contrast):
-    '''Increase contrast of images by trimming high and low intensity values and re-normalizing'''
+def approximate_percentiles(stk, percentiles, max_error):
+    '''Approximates percentiles of stk from a single histogram. Returns values within
+    max_error * (stk.max() - stk.min()) of np.percentile, and the min and max of stk'''
+    low, high = float(stk.min()), float(stk.max())
+    if low == high:
+        return [low for p in percentiles], low, high
+    n_bins = int(np.ceil(0.5 / max_error))
+    counts, edges = np.histogram(stk, bins=n_bins, range=(low, high))
+    cumulative = np.cumsum(counts)
+    centers = (edges[:-1] + edges[1:]) / 2.0
+    values = []
+    for p in percentiles:
+        # interpolate between closest ranks like np.percentile, estimating each by its bin center
+        rank = p / 100.0 * (stk.size - 1)
+        ranks = [int(np.floor(rank)), int(np.ceil(rank))]
+        below, above = centers[np.searchsorted(cumulative, ranks, side='right')]
+        values.append(below + (rank - ranks[0]) * (above - below))
+    return values, low, high
+
+
+def improve_contrast(stks, upper_contrast, lower_contrast, max_error=0):
+    '''Increase contrast of images by trimming high and low intensity values and re-normalizing.
+    If max_error > 0, percentiles are approximated to within max_error of each stack's value
+    range and float32 stacks are normalized in place instead of copied'''
+    if max_error > 0:
+        return [improve_contrast_in_place(np.asarray(stk, dtype=np.float32), upper_contrast,
+                                          lower_contrast, max_error) for stk in stks]
     new_data = []
     for i, stk in enumerate(stks):
         low_p = np.percentile(stk.flatten(), lower_contrast)
@@ -39,17 +70,42 @@ def improve_contrast(stks, upper_contrast, lower_contrast):
     return new_data
 
 
+def improve_contrast_in_place(stk, upper_contrast, lower_contrast, max_error):
+    '''Trims and re-normalizes float32 stk in place using approximate percentiles'''
+    (low_p, high_p), low, high = approximate_percentiles(stk, [lower_contrast, upper_contrast], max_error)
+    np.clip(stk, low_p, high_p, out=stk)
+    low, high = max(low, low_p), min(high, high_p)
+    stk -= np.float32(low)
+    if high > low:
+        stk *= np.float32(1.0 / (high - low))
+    return stk
+
+
 def get_centroids(input_rois, radius, img_width, img_height):
     '''Convert ImageJ ROIs into centroids for improved convnet boundary detection'''
+    # offsets of pixels in a disk of argument radius
+    dx, dy = np.mgrid[-radius:radius+1, -radius:radius+1]
+    disk = dx**2 + dy**2 <= radius**2
+    dx, dy = dx[disk], dy[disk]
+
     new_data = []
     for j, rois in enumerate(input_rois):
         new_rois = np.zeros(rois.shape, dtype='float32')
-        for i, r in enumerate(rois):
-            cx, cy = np.where(r != 0)
-            cx, cy = int(cx.mean()), int(cy.mean())
-            x, y = np.ogrid[0:img_width, 0:img_height]
-            index = (x-cx)**2 + (y-cy)**2 <= radius**2
-            new_rois[i, index] = 1
+
+        # integer centroids of all ROIs from one pass over their nonzero pixels
+        index, x, y = np.nonzero(rois)
+        counts = np.bincount(index, minlength=len(rois))
+        has_pixels = counts > 0
+        counts = counts[has_pixels]
+        cx = (np.bincount(index, weights=x, minlength=len(rois))[has_pixels] / counts).astype(int)
+        cy = (np.bincount(index, weights=y, minlength=len(rois))[has_pixels] / counts).astype(int)
+
+        # stamp disk around each centroid, clipped to image
+        index = np.repeat(np.flatnonzero(has_pixels), len(dx))
+        x = (cx[:, np.newaxis] + dx).ravel()
+        y = (cy[:, np.newaxis] + dy).ravel()
+        inside = (x >= 0) & (x < img_width) & (y >= 0) & (y < img_height)
+        new_rois[index[inside], x[inside], y[inside]] = 1
         new_data.append(new_rois)
     return new_data
 
@@ -83,86 +139,250 @@ def is_labeled(dir_path):
     return 'labeled' in os.path.basename(os.path.dirname(dir_path))
 
 
-def downsample_helper(files_list, img_width, img_height, mean_proj_bins, max_proj_bins):
-    '''Mean and max project to covert image files in list to single downsampled numpy array'''
-    mean_stack = np.zeros((0, img_width, img_height), dtype=np.float32)
-    full_stack = np.zeros((0, img_width, img_height), dtype=np.float32)
+def projection_bins(n_frames, bin_size):
+    '''Number of bins produced by projecting n_frames frames bin_size at a time.
+    A trailing partial bin is merged into the last full bin'''
+    if n_frames == 0:
+        return 0
+    return max(1, n_frames // bin_size)
+
+
+def downsample_helper(files_list, img_width, img_height, mean_proj_bins, max_proj_bins, chunk_size=256):
+    '''Mean and max project to covert image files in list to single downsampled numpy array.
+    Frames are streamed chunk_size at a time, with partial bins carried over between chunks
+    and sub-videos, so memory use is bounded by one chunk rather than the whole video'''
+    n_frames = sum([stack_length(f) for f in files_list])
+    n_mean = projection_bins(n_frames, mean_proj_bins)
+    n_max = projection_bins(n_mean, max_proj_bins)
+    max_stack = np.zeros((n_max, img_width, img_height), dtype=np.float32)
 
-    # mean projections
+    mean_sum = np.zeros((img_width, img_height), dtype=np.float32)
+    frame, mean_count, mean_index, max_count = 0, 0, 0, 0
     for f in files_list:
-        full_stack = np.vstack((full_stack, load_stack(f)))
-        for i in range(0, full_stack.shape[0], mean_proj_bins):
-            if full_stack.shape[0] - (i + mean_proj_bins) < mean_proj_bins and f == files_list[-1]:
-                    m = np.mean(full_stack[i:, :, :], axis=0)
-                    m = np.expand_dims(m, axis=0)
-                    mean_stack = np.vstack((mean_stack, m))
-                    break
-            elif full_stack.shape[0] - i < mean_proj_bins:
-                full_stack = full_stack[i:, :, :]
-            else:
-                m = np.mean(full_stack[i:i+mean_proj_bins, :, :], axis=0)
-                m = np.expand_dims(m, axis=0)
-                mean_stack = np.vstack((mean_stack, m))
-
-    # max projections
-    max_stack = np.zeros((0, img_width, img_height), dtype=np.float32)
-    for i in range(0, mean_stack.shape[0], max_proj_bins):
-        if mean_stack.shape[0] - (i + max_proj_bins) < max_proj_bins:
-            m = np.max(mean_stack[i:, :, :], axis=0)
-            m = np.expand_dims(m, axis=0)
-            max_stack = np.vstack((max_stack, m))
-            break
-        else:
-            m = np.max(mean_stack[i:i+max_proj_bins, :, :], axis=0)
-            m = np.expand_dims(m, axis=0)
-            max_stack = np.vstack((max_stack, m))
+        for chunk in load_stack_chunks(f, chunk_size):
+            for im in chunk:
+                # mean projections, summed frame by frame in the same order as np.mean
+                np.add(mean_sum, im, out=mean_sum)
+                mean_count += 1
+                frame += 1
+                if frame != n_frames and (frame % mean_proj_bins != 0 or mean_index == n_mean - 1):
+                    continue
+                m = np.true_divide(mean_sum, mean_count)
+                mean_sum[...] = 0
+                mean_count = 0
+
+                # max projections of completed mean projections
+                max_index = min(mean_index // max_proj_bins, n_max - 1)
+                if max_count == 0:
+                    max_stack[max_index] = m
+                else:
+                    np.maximum(max_stack[max_index], m, out=max_stack[max_index])
+                max_count += 1
+                mean_index += 1
+                if mean_index == n_mean or (mean_index % max_proj_bins == 0 and max_index < n_max - 1):
+                    max_count = 0
     return max_stack
 
 
-def downsample(src_dir, dst_dir, img_width, img_height, mean_proj_bins, max_proj_bins):
-    '''Downsample image stacks in src_dir and place results and roi .zip files in dst_dir'''
-    do_copy = src_dir != dst_dir
-    for f in os.listdir(src_dir):
-        ext = os.path.splitext(f)[1].lower()
+def downsample_file(src_paths, dst_path, img_width, img_height, mean_proj_bins, max_proj_bins):
+    '''Downsample video split across src_paths and save result as dst_path'''
+    result = downsample_helper(src_paths, img_width, img_height, mean_proj_bins, max_proj_bins)
+    tifffile.imsave(dst_path, result.squeeze())
 
-        # skip hidden files
-        if ext.strip() == '':
-            continue
-        
-        # copy .zip roi files without modification
-        if ext == '.zip' and do_copy:
+
+def copy_roi_zips(src_dir, dst_dir):
+    '''Copy roi .zip files in src_dir to dst_dir without modification'''
+    if src_dir == dst_dir:
+        return
+    for f in sorted(os.listdir(src_dir)):
+        if os.path.splitext(f)[1].lower() == '.zip':
             shutil.copy(src_dir + f, dst_dir)
 
-        # downsample individual videos
-        elif ext == '.tif' or ext == '.tiff':
-            result = downsample_helper([src_dir + f], img_width, img_height,
-                                       mean_proj_bins, max_proj_bins)
-            tifffile.imsave(dst_dir + f, result.squeeze())
 
-        # downsample folders with videos split into smaller time chunks
-        elif os.path.isdir(src_dir + f):
-            sub_videos = [src_dir + add_pathsep(f) + v for v in os.listdir(src_dir + f)
+def downsample(src_dir, dst_dir, img_width, img_height, mean_proj_bins, max_proj_bins, num_workers=1):
+    '''Downsample videos in src_dir, including folders of videos split into smaller
+    time chunks, and place results and roi .zip files in dst_dir'''
+    copy_roi_zips(src_dir, dst_dir)
+    videos = find_videos(src_dir, True)
+    tasks = [(src_paths, dst_dir + name + '.tif', img_width, img_height, mean_proj_bins, max_proj_bins)
+             for name, src_paths in videos]
+    run_tasks(downsample_file, tasks, num_workers, [src_dir + name for name, src_paths in videos])
+
+
+def time_resampling_weights(n_frames, new_time_depth, mode='spline'):
+    '''Returns (new frame #, frame #) matrix resampling a time series of n_frames frames to
+    new_time_depth frames. mode is 'spline' or 'linear' for the cubic spline or linear
+    interpolation of scipy's zoom, or 'block_mean' for averaging over each new frame's interval'''
+    factor = float(new_time_depth) / n_frames
+    n_new_frames = int(round(n_frames * factor))
+    if mode == 'spline' or mode == 'linear':
+        # zoom is linear, so its weights are the responses to unit impulses
+        order = 3 if mode == 'spline' else 1
+        weights = np.empty((n_new_frames, n_frames))
+        impulse = np.zeros(n_frames)
+        for i in range(n_frames):
+            impulse[i] = 1
+            weights[:, i] = zoom(impulse, factor, order=order)
+            impulse[i] = 0
+    elif mode == 'block_mean':
+        edges = np.linspace(0, n_frames, n_new_frames + 1)
+        frames = np.arange(n_frames)
+        overlaps = (np.minimum(edges[1:, np.newaxis], frames + 1) -
+                    np.maximum(edges[:-1, np.newaxis], frames))
+        weights = np.clip(overlaps, 0, None)
+        weights /= weights.sum(axis=1)[:, np.newaxis]
+    else:
+        raise ValueError("Unknown time equalization mode " + str(mode))
+    return weights
+
+
+def time_equalize_stack(stk, new_time_depth, mode='spline', tile_size=1 << 23):
+    '''Resample image stack to new_time_depth frames along the time axis only.
+    Pixels are resampled in tiles of about tile_size frames * pixels at a time'''
+    weights = time_resampling_weights(stk.shape[0], new_time_depth, mode)
+    pixels = stk.reshape((stk.shape[0], -1))
+    resized = np.empty((weights.shape[0], pixels.shape[1]), dtype=stk.dtype)
+    step = max(1, tile_size // stk.shape[0])
+    for start in range(0, pixels.shape[1], step):
+        resized[:, start:start+step] = np.dot(weights, pixels[:, start:start+step])
+    return resized.reshape((weights.shape[0],) + stk.shape[1:])
+
+
+def time_equalize_file(src_path, dst_path, new_time_depth, mode='spline'):
+    '''Resample image stack in src_path to new_time_depth frames and save result as dst_path'''
+    resized = time_equalize_stack(load_stack(src_path), new_time_depth, mode)
+    tifffile.imsave(dst_path, resized.squeeze())
+
+
+def time_equalize(src_dir, dst_dir, img_width, img_height, new_time_depth, num_workers=1, mode='spline'):
+    '''Make image stacks in src_dir have the same number of frames.  Place results
+    and roi .zip files in dst_dir'''
+    copy_roi_zips(src_dir, dst_dir)
+    videos = find_videos(src_dir, False)
+    tasks = [(src_paths[0], dst_dir + name + '.tif', new_time_depth, mode) for name, src_paths in videos]
+    run_tasks(time_equalize_file, tasks, num_workers, [src_dir + name for name, src_paths in videos])
+
+
+def find_videos(src_dir, split_folders):
+    '''Returns sorted (name, video paths) pairs for the videos in src_dir. If split_folders,
+    folders of videos split into smaller time chunks are included as single videos'''
+    videos = []
+    for f in sorted(os.listdir(src_dir)):
+        name, ext = f.rsplit('.')[0], os.path.splitext(f)[1].lower()
+        if f.startswith('.'):
+            continue
+        if ext == '.tif' or ext == '.tiff':
+            videos.append((name, [src_dir + f]))
+        elif split_folders and os.path.isdir(src_dir + f):
+            sub_videos = [src_dir + add_pathsep(f) + v for v in sorted(os.listdir(src_dir + f))
                           if (os.path.splitext(v)[1].lower() == '.tif' or
                               os.path.splitext(v)[1].lower() == '.tiff')]
-            result = downsample_helper(sub_videos, img_width, img_height, mean_proj_bins, max_proj_bins)
-            tifffile.imsave(dst_dir + f + '.tif', result.squeeze())
-
-
-def time_equalize(src_dir, dst_dir, img_width, img_height, new_time_depth):
-    '''Make image stacks in src_dir have the same number of frames.  Place results in dst_dir'''
-    do_copy = src_dir != dst_dir
-    for f in os.listdir(src_dir):
-        ext = os.path.splitext(f)[1].lower()
-
-        # copy zip roi files without modification
-        if ext == '.zip' and do_copy:
-            shutil.copy(src_dir + f, dst_dir)
-
-        # time equalize indvidual videos
-        elif ext == '.tif' or ext == '.tiff':
-            data = load_stack(src_dir + f)
-            resized = zoom(data, (float(new_time_depth)/data.shape[0], 1, 1))
-            tifffile.imsave(dst_dir + f, resized.squeeze())
+            videos.append((name, sub_videos))
+    return videos
+
+
+def preprocess_video(src_paths, roi_path, file_name, dst_dir, intermediate_dir, do_downsample,
+                     img_width, img_height, mean_proj_bins, max_proj_bins, new_time_depth, time_mode,
+                     upper_contrast, lower_contrast, contrast_max_error, centroid_radius):
+    '''Downsample, time equalize and improve contrast of the video in src_paths in memory and
+    save only the result in dst_dir. If roi_path is not None, its ROIs are converted to
+    centroids and saved in dst_dir. If intermediate_dir is not None, the time equalized
+    video and ROI .zip file are also saved there'''
+    if do_downsample:
+        stk = downsample_helper(src_paths, img_width, img_height, mean_proj_bins, max_proj_bins)
+    else:
+        stk = load_stack(src_paths[0])
+    stk = time_equalize_stack(stk, new_time_depth, time_mode)
+    if intermediate_dir is not None:
+        tifffile.imsave(add_pathsep(intermediate_dir) + file_name + '.tif', stk.squeeze())
+        if roi_path is not None:
+            shutil.copy(roi_path, intermediate_dir)
+
+    stks = improve_contrast([stk], upper_contrast, lower_contrast, contrast_max_error)
+    save_image_tifs(stks, [file_name], dst_dir)
+    if roi_path is not None:
+        rois = get_centroids([load_rois(roi_path, img_width, img_height)],
+                             centroid_radius, img_width, img_height)
+        save_roi_tifs(rois, [file_name], dst_dir)
+
+
+def file_sha1(path, known_hashes):
+    '''Returns SHA-1 hex digest of file contents. known_hashes maps paths to previously
+    computed {size, mtime, sha1} and is reused and updated for files that did not change'''
+    stat = os.stat(path)
+    known = known_hashes.get(path)
+    if known is not None and known['size'] == stat.st_size and known['mtime'] == stat.st_mtime:
+        return known['sha1']
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    known_hashes[path] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': sha1.hexdigest()}
+    return sha1.hexdigest()
+
+
+def group_source_files(src_dir):
+    '''Returns dict from base names in src_dir to the files they consist of,
+    including the sub-videos of videos split into folders'''
+    groups = {}
+    for f in sorted(os.listdir(src_dir)):
+        name = f.rsplit('.')[0]
+        if name == '':
+            continue
+        if os.path.isdir(src_dir + f):
+            paths = [src_dir + add_pathsep(f) + v for v in sorted(os.listdir(src_dir + f))
+                     if os.path.isfile(src_dir + add_pathsep(f) + v)]
+        else:
+            paths = [src_dir + f]
+        groups.setdefault(name, []).extend(paths)
+    return groups
+
+
+def cache_key(paths, params, known_hashes):
+    '''Returns key identifying the contents of paths preprocessed with params'''
+    contents = [(os.path.basename(p), file_sha1(p, known_hashes)) for p in paths]
+    return hashlib.sha1(json.dumps([params, contents], sort_keys=True)).hexdigest()
+
+
+def load_manifest(manifest_fpath):
+    '''Reads preprocessing cache manifest, returning an empty one if it does not exist'''
+    if not os.path.isfile(manifest_fpath):
+        return {'hashes': {}, 'outputs': {}}
+    with open(manifest_fpath, 'r') as manifest_file:
+        return json.load(manifest_file)
+
+
+def save_manifest(manifest, manifest_fpath):
+    '''Writes preprocessing cache manifest, replacing any previous one only once fully written'''
+    tmp_fpath = manifest_fpath + '.tmp'
+    with open(tmp_fpath, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+    if os.path.isfile(manifest_fpath):
+        os.remove(manifest_fpath)
+    os.rename(tmp_fpath, manifest_fpath)
+
+
+def prune_outputs(manifest, ttv, names):
+    '''Deletes cached outputs of files in split ttv that are no longer in names'''
+    for entry in manifest['outputs'].keys():
+        if entry.startswith(ttv) and entry[len(ttv):] not in names:
+            for f in manifest['outputs'][entry]['files']:
+                if os.path.isfile(f):
+                    os.remove(f)
+            del manifest['outputs'][entry]
+
+
+def list_outputs(names, directories):
+    '''Returns dict from names to the files in directories generated for them'''
+    outputs = dict((name, []) for name in names)
+    for directory in directories:
+        for f in sorted(os.listdir(directory)):
+            base = f.rsplit('.')[0]
+            if base.endswith('_ROI'):
+                base = base[:-len('_ROI')]
+            if base in outputs and os.path.isfile(directory + f):
+                outputs[base].append(directory + f)
+    return outputs
 
 
 def remove_ds_store(file_list):
@@ -219,8 +439,9 @@ def put_labeled_at_end_of_path_if_not_there(fpath):
         return fpath
 
 
-def main(main_config_fpath='../data/example/main_config.cfg'):
-    '''Get user-specified information from main_config.cfg'''
+def main(main_config_fpath='../data/example/main_config.cfg', num_workers=None):
+    '''Get user-specified information from main_config.cfg. Independent files are
+    processed by num_workers processes, read from main_config.cfg if None'''
     cfg_parser = ConfigParser.SafeConfigParser()
     cfg_parser.readfp(open(main_config_fpath, 'r'))
 
@@ -230,11 +451,15 @@ def main(main_config_fpath='../data/example/main_config.cfg'):
     preprocess_dir = data_dir[0:-1] + "_preprocessed" + os.sep
     ttv_list = ['training' + os.sep, 'validation' + os.sep, 'test' + os.sep]
 
+    # time equalized videos are only written to downsample_dir for debugging
+    write_intermediates = (cfg_parser.has_option('preprocessing', 'write_intermediates') and
+                           cfg_parser.getboolean('preprocessing', 'write_intermediates'))
+
     # ensure directories exist
     if not os.path.isdir(data_dir):
         sys.exit("Specified data directory " + data_dir + " does not exist.")
     for ttv in ttv_list if is_labeled(data_dir) else ['']:
-        if not os.path.isdir(downsample_dir + ttv):
+        if write_intermediates and not os.path.isdir(downsample_dir + ttv):
             os.makedirs(downsample_dir + ttv)
         if not os.path.isdir(preprocess_dir + ttv):
             os.makedirs(preprocess_dir + ttv)
@@ -242,35 +467,80 @@ def main(main_config_fpath='../data/example/main_config.cfg'):
     # get remaining preprocessing parameters
     img_width = cfg_parser.getint('general', 'img_width')
     img_height = cfg_parser.getint('general', 'img_height')
+    configure_roi_cache(cfg_parser)
+    do_downsample = cfg_parser.getboolean('general', 'do_downsample')
     mean_proj_bins = cfg_parser.getint('preprocessing', 'mean_proj_bin')
     max_proj_bins = cfg_parser.getint('preprocessing', 'max_proj_bin')
     new_time_depth = cfg_parser.getint('preprocessing', 'time_equalize')
+    time_mode = 'spline'
+    if cfg_parser.has_option('preprocessing', 'time_equalize_mode'):
+        time_mode = cfg_parser.get('preprocessing', 'time_equalize_mode')
     upper_contrast = cfg_parser.getfloat('preprocessing', 'upper_contrast')
     lower_contrast = cfg_parser.getfloat('preprocessing', 'lower_contrast')
+    contrast_max_error = 0.0
+    if cfg_parser.has_option('preprocessing', 'contrast_max_error'):
+        contrast_max_error = cfg_parser.getfloat('preprocessing', 'contrast_max_error')
     centroid_radius = cfg_parser.getint('preprocessing', 'centroid_radius')
+    if num_workers is None:
+        num_workers = get_num_workers(cfg_parser, 'preprocessing')
+
+    # outputs are only regenerated if input contents or these parameters change
+    use_cache = (not cfg_parser.has_option('preprocessing', 'use_cache') or
+                 cfg_parser.getboolean('preprocessing', 'use_cache'))
+    manifest_fpath = data_dir[0:-1] + "_preprocess_manifest.json"
+    manifest = load_manifest(manifest_fpath) if use_cache else {'hashes': {}, 'outputs': {}}
+    params = {'version': 1, 'img_width': img_width, 'img_height': img_height,
+              'do_downsample': do_downsample, 'time_equalize': new_time_depth,
+              'time_equalize_mode': time_mode,
+              'upper_contrast': upper_contrast, 'lower_contrast': lower_contrast,
+              'contrast_max_error': contrast_max_error,
+              'centroid_radius': centroid_radius, 'labeled': is_labeled(data_dir),
+              'write_intermediates': write_intermediates}
+    if do_downsample:
+        params.update({'mean_proj_bin': mean_proj_bins, 'max_proj_bin': max_proj_bins})
+    for path in manifest['hashes'].keys():
+        if not os.path.isfile(path):
+            del manifest['hashes'][path]
 
     # run preprocessing
     for ttv in ttv_list if is_labeled(data_dir) else ['']:
-        if cfg_parser.getboolean('general', 'do_downsample'):
-            downsample(data_dir + ttv, downsample_dir + ttv,
-                       img_width, img_height, mean_proj_bins, max_proj_bins)
-            time_equalize(downsample_dir + ttv, downsample_dir + ttv,
-                          img_width, img_height, new_time_depth)
-        else:
-            time_equalize(data_dir + ttv, downsample_dir + ttv,
-                          img_width, img_height, new_time_depth)
-
-        if is_labeled(data_dir):    
-            stks, rois, file_names = load_data(downsample_dir + ttv, img_width, img_height)
-            stks = improve_contrast(stks, upper_contrast, lower_contrast)
-            rois = get_centroids(rois, centroid_radius, img_width, img_height)
-            save_image_tifs(stks, file_names, preprocess_dir + ttv)
-            save_roi_tifs(rois, file_names, preprocess_dir + ttv)
-        else:
-            stks, file_names = load_data(downsample_dir + ttv, img_width, img_height, no_rois=True)
-            stks = improve_contrast(stks, upper_contrast, lower_contrast)
-            save_image_tifs(stks, file_names, preprocess_dir + ttv)
+        only = None
+        if use_cache:
+            sources = group_source_files(data_dir + ttv)
+            keys = dict((name, cache_key(sources[name], params, manifest['hashes'])) for name in sources)
+            prune_outputs(manifest, ttv, keys)
+            only = set([name for name in keys
+                        if ttv + name not in manifest['outputs'] or
+                        manifest['outputs'][ttv + name]['key'] != keys[name] or
+                        not all(map(os.path.isfile, manifest['outputs'][ttv + name]['files']))])
+            print str(len(keys) - len(only)) + " of " + str(len(keys)) + " files in " + data_dir + ttv + " unchanged"
+
+        tasks = []
+        names = []
+        for name, src_paths in find_videos(data_dir + ttv, do_downsample):
+            if only is not None and name not in only:
+                continue
+            roi_path = data_dir + ttv + name + '.zip' if is_labeled(data_dir) else None
+            tasks.append((src_paths, roi_path, name, preprocess_dir + ttv,
+                          downsample_dir + ttv if write_intermediates else None, do_downsample,
+                          img_width, img_height, mean_proj_bins, max_proj_bins, new_time_depth, time_mode,
+                          upper_contrast, lower_contrast, contrast_max_error, centroid_radius))
+            names.append(data_dir + ttv + name)
+        run_tasks(preprocess_video, tasks, num_workers, names,
+                  initializer=set_roi_cache, initargs=roi_cache_settings())
+
+        if use_cache:
+            output_dirs = [preprocess_dir + ttv] + ([downsample_dir + ttv] if write_intermediates else [])
+            outputs = list_outputs(only, output_dirs)
+            for name in only:
+                manifest['outputs'][ttv + name] = {'key': keys[name], 'files': outputs[name]}
+            save_manifest(manifest, manifest_fpath)
             
 
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 2:
+        main(sys.argv[1], int(sys.argv[2]))
+    elif len(sys.argv) > 1:
+        main(sys.argv[1])
+    else:
+        main()
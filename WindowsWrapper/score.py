@@ -12,19 +12,29 @@
 #    1) from test import Score
 #    2) s = Score(None, None, ground_truth_rois, predicted_rois)
 #         where *_rois has type [index, numpy.array(roi #, width px, height px)]
+#         or [index, load.RoiSet]
 #    3) str(s) pretty-formats results
+#    To score many prediction sets against the same ground truth,
+#    build index = GroundTruthIndex(ground_truth_rois) once and use
+#    Score(index, predicted_rois) or index.score_batch(prediction_sets)
+#    score_labeled_data scores labeled splits one file pair at a time,
+#    writing score.txt and per-file scores.csv to each split directory
 #
 ################################################################
 
 
 import numpy as np
-from itertools import chain
+from scipy import sparse
+from scipy.optimize import linear_sum_assignment
+from itertools import chain, izip
 import random
 import os
-from collections import defaultdict
+import sys
+import csv
 import os.path
 import load
 from preprocess import is_labeled, add_pathsep
+from parallel import map_tasks, get_num_workers
 import ConfigParser
 
 
@@ -37,9 +47,12 @@ class Score:
     self.predictions      = list of predicted ROIs (stack, ROI index, w, h)
     self.actual           = list of ground-truth ROIs (stack, ROI index, w, h)
     self.categorized      = list of predicted ROIs divided into FPs, FNs, and TPs matched with true ROIs
+                             each ROI is a 1 x (w*h) scipy.sparse row
                              pred ROIs with <0.5 overlap to any true ROI are false positives
                              true ROIs with <0.5 overlap to any pred ROI are false negatives
-                             true positive pairs are made by maximizing overlap between pairs
+                             true positive pairs are made by maximizing overlap between pairs,
+                             greedily in prediction order or, with assignment='optimal',
+                             for the total overlap of all pairs
                              e.g. self.categorized[0]["fps"][n] = nth false positive ROI from the 0th image stack
                              e.g. self.categorized[0]["tps"][n] = nth (pred ROI, true ROI) pair from 0th image stack
     self.total_f1_score   = F1 score with all image stacks merged
@@ -53,17 +66,17 @@ class Score:
                              e.g. self.total_overlap_bq["mean precision"] = 
                                mean (pixels in both pred_roi and true_roi) / (pixels in pred_roi)
     self.overlap_bqs      = list of dicts as in self.total_overlap_bq with one dict per image stack                   
+
+    actual_labels may also be a GroundTruthIndex prepared once for many Scores.
     """
-    def __init__(self, actual_labels, predicted_labels):
+    def __init__(self, actual_labels, predicted_labels, assignment='greedy'):
         self.predictions = predicted_labels
-        self.actual = actual_labels
-        # assert that predicted and true ROI stacks are the same shape
-        assert(all([self.predictions[i].shape[1] == self.actual[i].shape[1] 
-                    for i in range(len(self.actual))]))
-        # assert that predicted ROI stacks are 0-1 arrays
-        assert(all([np.all(np.logical_or(self.predictions[i] == 1, self.predictions[i] == 0)) 
-                    for i in range(len(self.predictions))]))
-        self.categorized = categorize(self.predictions, self.actual)
+        if isinstance(actual_labels, GroundTruthIndex):
+            index = actual_labels
+        else:
+            index = GroundTruthIndex(actual_labels)
+        self.actual = index.actual
+        self.categorized = index.categorize(self.predictions, assignment)
         self.precisions, self.total_precision, self.recalls, self.total_recall = calc_precision_recall(self.categorized)
         self.f1_scores = map(calc_f1_score, zip(self.precisions, self.recalls))
         #print self.f1_scores
@@ -83,35 +96,232 @@ class Score:
         string += "Overlap Boundary Quality, per stack  = {!s}\n\n".format(self.overlap_bqs)
         return string
     
+
+class StreamingScore(Score):
+    """Score accumulated one image stack at a time from the results of score_file_pair,
+    so that no ROIs or TP pairs are kept in memory. Has the attributes of Score except
+    predictions, actual and categorized, plus
+
+    self.filenames        = list of names of scored stacks
+    self.tp_moments       = dict of (count, mean, sum of squared deviations) of the
+                            "precision" and "recall" of all TP pairs
+
+    Totals are updated by update_totals, which add does not call
+    """
+    def __init__(self):
+        self.filenames = []
+        self.precisions = []
+        self.recalls = []
+        self.f1_scores = []
+        self.overlap_bqs = []
+        self.tp_moments = {"precision":(0, 0.0, 0.0), "recall":(0, 0.0, 0.0)}
+        self.update_totals()
+
+    def add(self, filename, result):
+        """Adds the scores of one stack as returned by score_file_pair"""
+        self.filenames.append(filename)
+        self.precisions.append(result["precision"])
+        self.recalls.append(result["recall"])
+        self.f1_scores.append(result["f1_score"])
+        self.overlap_bqs.append(result["overlap_bq"])
+        num_tps = result["num_tps"]
+        if num_tps > 0:
+            for quality in self.tp_moments:
+                mean, std = result["overlap_bq"]["mean " + quality], result["overlap_bq"]["std " + quality]
+                self.tp_moments[quality] = merge_moments(self.tp_moments[quality], (num_tps, mean, std ** 2 * num_tps))
+
+    def update_totals(self):
+        """Computes totals over all stacks added so far"""
+        if len(self.filenames) == 0:
+            self.total_precision = self.total_recall = self.total_f1_score = 0
+            self.total_overlap_bq = {}
+            return
+        self.total_precision = np.mean(self.precisions)
+        self.total_recall = np.mean(self.recalls)
+        self.total_f1_score = np.mean(self.f1_scores)
+        mean_std = {}
+        for quality, (count, mean, m2) in self.tp_moments.items():
+            if count == 0:
+                mean_std[quality] = np.nan, np.nan
+            else:
+                mean_std[quality] = mean, np.sqrt(m2 / count)
+        self.total_overlap_bq = {"mean precision":mean_std["precision"][0], "std precision":mean_std["precision"][1],
+                                 "mean recall":mean_std["recall"][0], "std recall":mean_std["recall"][1]}
+
         
-def categorize(predictions, labels):
-    "Divide predictions and labels into FPs, FNs, and TPs"
-    categorized = []
-    for i in range(len(predictions)):
-        categorized.append({"fps":[], "fns":[], "tps":[]})
-        rois_pred, rois_true = list(predictions[i].copy()), list(labels[i].copy())
-        for roi_pred in rois_pred:
-            overlaps = map(lambda roi_true: calc_overlap(roi_pred, roi_true)[0], rois_true)
-            best_overlap, best_index = np.max(overlaps), np.argmax(overlaps)
-            if best_overlap > 0.5:
-                categorized[i]["tps"].append((roi_pred, rois_true[best_index]))
-                del rois_true[best_index]
+class GroundTruthIndex:
+    """Ground-truth ROIs of a list of image stacks prepared once for scoring
+    many sets of predicted ROIs against them.
+
+    self.actual      = list of ground-truth load.RoiSets, one per stack
+    self.true_sizes  = list of arrays of ground-truth ROI pixel counts per stack
+    """
+    def __init__(self, actual_labels):
+        self.actual = [load.as_roi_set(a) for a in actual_labels]
+        self.true_sizes = [a.areas().astype(np.float64) for a in self.actual]
+
+    def __len__(self):
+        return len(self.actual)
+
+    def match(self, predictions, assignment='greedy'):
+        """Matches predicted ROIs of each stack to ground truth as in categorize.
+        Returns predictions as load.RoiSets and, per stack, (pred index, true index)
+        pairs with the (precision, recall) of each pair as in calc_overlap"""
+        predictions = [load.as_roi_set(p) for p in predictions]
+        # assert that predicted and true ROI stacks are the same shape
+        assert(all([predictions[i].shape[1] == self.actual[i].shape[1] 
+                    for i in range(len(self.actual))]))
+        # assert that predicted ROI stacks are 0-1 arrays
+        assert(all([p.is_binary() for p in predictions]))
+        matches = []
+        for i in range(len(predictions)):
+            rois_pred = predictions[i].masks
+            pred_sizes = np.asarray(rois_pred.sum(axis=1), dtype=np.float64).ravel()
+            intersections = pair_intersections(rois_pred, self.actual[i].masks)
+            overlaps = intersection_overlaps(intersections, pred_sizes, self.true_sizes[i])
+            if assignment == 'greedy':
+                pairs = greedy_pairs(overlaps)
+            elif assignment == 'optimal':
+                pairs = optimal_pairs(overlaps)
             else:
-                categorized[i]["fps"].append(roi_pred)
-        for roi_true in rois_true:
-            categorized[i]["fns"].append(roi_true)
-    return categorized
+                raise ValueError('assignment should be one of "greedy" or "optimal"', assignment)
+            qualities = [(intersections[j, k] / pred_sizes[j], intersections[j, k] / self.true_sizes[i][k])
+                         for j, k in pairs]
+            matches.append((pairs, qualities))
+        return predictions, matches
+
+    def categorize(self, predictions, assignment='greedy'):
+        """categorize predictions of every stack against the ground truth"""
+        predictions, matches = self.match(predictions, assignment)
+        categorized = []
+        for i, (pairs, qualities) in enumerate(matches):
+            rois_pred, rois_true = predictions[i].masks, self.actual[i].masks
+            matched_pred = set([j for j, k in pairs])
+            matched_true = set([k for j, k in pairs])
+            categorized.append({"fps":[rois_pred[j] for j in range(rois_pred.shape[0]) if j not in matched_pred],
+                                "fns":[rois_true[k] for k in range(rois_true.shape[0]) if k not in matched_true],
+                                "tps":[(rois_pred[j], rois_true[k]) for j, k in pairs],
+                                "tp_qualities":qualities})
+        return categorized
+
+    def score_batch(self, prediction_sets, assignment='greedy'):
+        """Scores each set of predicted ROIs, a list with one ROI stack per ground-truth
+        stack, as Score does without building categorized ROI lists. Returns a dict of
+        arrays with one row per prediction set:
+            "f1_scores", "precisions", "recalls" with one column per stack,
+            "total_f1_score", "total_precision", "total_recall",
+        and lists with one entry per prediction set:
+            "overlap_bqs", "total_overlap_bq" as in Score"""
+        counts = np.zeros((len(prediction_sets), len(self), 3))
+        overlap_bqs = []
+        total_overlap_bq = []
+        for s, predictions in enumerate(prediction_sets):
+            predictions, matches = self.match(predictions, assignment)
+            for i, (pairs, qualities) in enumerate(matches):
+                counts[s, i] = [len(pairs), predictions[i].shape[0], self.actual[i].shape[0]]
+            qualities = [{"tp_qualities":qualities} for pairs, qualities in matches]
+            bqs, total_bq = overlap_boundary_quality(qualities)
+            overlap_bqs.append(bqs)
+            total_overlap_bq.append(total_bq)
+        precisions, recalls = precision_recall(counts[:, :, 0], counts[:, :, 1], counts[:, :, 2])
+        f1_scores = f1_score(precisions, recalls)
+        return {"f1_scores":f1_scores, "precisions":precisions, "recalls":recalls,
+                "total_f1_score":f1_scores.mean(axis=1), "total_precision":precisions.mean(axis=1),
+                "total_recall":recalls.mean(axis=1),
+                "overlap_bqs":overlap_bqs, "total_overlap_bq":total_overlap_bq}
+
+def categorize(predictions, labels, assignment='greedy'):
+    """Divide predictions and labels into FPs, FNs, and TPs.
+    TP pairs need overlap > 0.5 and are matched in prediction order to the unmatched
+    true ROI of largest overlap (assignment='greedy') or chosen to maximize the
+    total overlap of all pairs (assignment='optimal')"""
+    return GroundTruthIndex(labels).categorize(predictions, assignment)
+
+def pair_intersections(rois_pred, rois_true):
+    """Sparse (pred ROI, true ROI) matrix of pixel intersections for ROI masks given as
+    sparse rows. All pairs come from one sparse product and only intersecting pairs are stored"""
+    intersections = sparse.csr_matrix(rois_pred.dot(rois_true.T), dtype=np.float64)
+    intersections.eliminate_zeros()
+    return intersections
+
+def intersection_overlaps(intersections, pred_sizes, true_sizes):
+    """Overlaps as in calc_overlap from sparse pair_intersections and ROI pixel counts"""
+    rows = np.repeat(np.arange(intersections.shape[0]), np.diff(intersections.indptr))
+    unions = pred_sizes[rows] + true_sizes[intersections.indices] - intersections.data
+    return sparse.csr_matrix((intersections.data / unions, intersections.indices, intersections.indptr),
+                             shape=intersections.shape)
+
+def greedy_pairs(overlaps):
+    """Matches each predicted ROI in turn to the unmatched true ROI of largest overlap,
+    the first one of equal overlaps, if that overlap is > 0.5.
+    Returns (pred index, true index) pairs"""
+    pairs = []
+    matched = np.zeros(overlaps.shape[1], dtype=bool)
+    for j in range(overlaps.shape[0]):
+        start, end = overlaps.indptr[j], overlaps.indptr[j+1]
+        unmatched = np.logical_not(matched[overlaps.indices[start:end]])
+        if not np.any(unmatched):
+            continue
+        true_indices = overlaps.indices[start:end][unmatched]
+        values = overlaps.data[start:end][unmatched]
+        best_overlap = values.max()
+        if best_overlap > 0.5:
+            k = true_indices[values == best_overlap].min()
+            pairs.append((j, k))
+            matched[k] = True
+    return pairs
+
+def optimal_pairs(overlaps):
+    """Matches predicted and true ROIs with overlap > 0.5 such that the total
+    overlap of matched pairs is maximal (Hungarian algorithm).
+    Returns (pred index, true index) pairs in prediction order"""
+    candidates = overlaps.multiply(overlaps > 0.5).tocoo()
+    if candidates.nnz == 0:
+        return []
+    rows, row_index = np.unique(candidates.row, return_inverse=True)
+    cols, col_index = np.unique(candidates.col, return_inverse=True)
+    weights = np.zeros((len(rows), len(cols)))
+    weights[row_index, col_index] = candidates.data
+    r, c = linear_sum_assignment(-weights)
+    matched = weights[r, c] > 0
+    return sorted(zip(rows[r[matched]], cols[c[matched]]))
 
 def calc_precision_recall(categorized):
     """Calculate precision and recall from categorized predictions and labels"""
     num_fps = [len(categorized[i]["fps"]) for i in range(len(categorized))]
     num_fns = [len(categorized[i]["fns"]) for i in range(len(categorized))]
     num_pairs = [len(categorized[i]["tps"]) for i in range(len(categorized))]
-    precisions = [num_pairs[i] / float(num_pairs[i] + num_fps[i]) if num_pairs[i] + num_fps[i] != 0 else 0 for i in range(len(categorized))]
-    recalls = [num_pairs[i] / float(num_pairs[i] + num_fns[i]) if num_pairs[i] + num_fns[i] != 0 else 0 for i in range(len(categorized))]
+    precisions, recalls = precision_recall(num_pairs, np.add(num_pairs, num_fps), np.add(num_pairs, num_fns))
+    precisions, recalls = precisions.tolist(), recalls.tolist()
     total_precision = np.mean(precisions) 
     total_recall = np.mean(recalls) 
     return precisions, total_precision, recalls, total_recall
+
+def precision_recall(num_tps, num_pred, num_true):
+    """Precision and recall from (arrays of) numbers of TP pairs, predicted ROIs and
+    true ROIs. Precision is 0 without predicted ROIs and recall is 0 without true ROIs"""
+    num_tps = np.asarray(num_tps, dtype=np.float64)
+    num_pred = np.asarray(num_pred, dtype=np.float64)
+    num_true = np.asarray(num_true, dtype=np.float64)
+    precisions = num_tps / np.where(num_pred != 0, num_pred, 1)
+    recalls = num_tps / np.where(num_true != 0, num_true, 1)
+    return precisions, recalls
+
+def f1_score(precisions, recalls):
+    """F1 score of (arrays of) precision and recall, 0 where recall is 0"""
+    precisions = np.asarray(precisions, dtype=np.float64)
+    recalls = np.asarray(recalls, dtype=np.float64)
+    return np.where(recalls == 0, 0, (2 * precisions * recalls) / np.where(recalls == 0, 1, precisions + recalls))
+
+def merge_moments((count_a, mean_a, m2_a), (count_b, mean_b, m2_b)):
+    """Combines the (count, mean, sum of squared deviations from the mean) of two sets of values"""
+    count = count_a + count_b
+    if count == 0:
+        return 0, 0.0, 0.0
+    delta = mean_b - mean_a
+    mean = mean_a + delta * count_b / float(count)
+    m2 = m2_a + m2_b + delta ** 2 * count_a * count_b / float(count)
+    return count, mean, m2
     
 def calc_overlap(roi_pred, roi_true):
     """For a given (2D array, 2D array) pair of predicted and true ROIs,
@@ -119,13 +329,16 @@ def calc_overlap(roi_pred, roi_true):
     precision = (# pixel intersection) / (# pixels in true ROI)
     recall    = (# pixel interection) / (# pixels in pred ROI)
     """
-    intersection = float(np.dot(roi_pred.flat, roi_true.flat))
+    if sparse.issparse(roi_pred):
+        intersection = float(roi_pred.multiply(roi_true).sum())
+    else:
+        intersection = float(np.dot(roi_pred.flat, roi_true.flat))
     
     if intersection == 0: 
         return 0, 0, 0
     
-    pred = np.sum(roi_pred)
-    true = np.sum(roi_true)
+    pred = roi_pred.sum()
+    true = roi_true.sum()
     union = pred + true - intersection
     
     precision = intersection / pred
@@ -135,14 +348,12 @@ def calc_overlap(roi_pred, roi_true):
 
 def calc_f1_score((precision, recall)):
     """F1 score is harmonic mean of precision and recall"""
-    if recall == 0:
-        return 0 
-    else:
-        return (2 * precision * recall) / (precision + recall)
+    return float(f1_score(precision, recall))
     
 def overlap_boundary_quality(categorized):
     """Calculates pixel-based mean and std of precision and recall 
-    of TP (pred roi, true roi) pairs
+    of TP (pred roi, true roi) pairs, taking them from "tp_qualities"
+    when categorize already computed them
     """
     qualities = []
     precisions = []
@@ -150,8 +361,11 @@ def overlap_boundary_quality(categorized):
     for i in range(len(categorized)):
         precisions.append([])
         recalls.append([])
-        for roi_pred, roi_true in categorized[i]["tps"]:
-            _, precision, recall = calc_overlap(roi_pred, roi_true)
+        if "tp_qualities" in categorized[i]:
+            tp_qualities = categorized[i]["tp_qualities"]
+        else:
+            tp_qualities = [calc_overlap(roi_pred, roi_true)[1:] for roi_pred, roi_true in categorized[i]["tps"]]
+        for precision, recall in tp_qualities:
             precisions[i].append(precision)
             recalls[i].append(recall)
         qualities.append({"mean precision": np.mean(precisions[i]), "std precision": np.std(precisions[i]),
@@ -163,34 +377,75 @@ def overlap_boundary_quality(categorized):
     return qualities, overall   
 
     
-def score_labeled_data(postprocess_dir, data_dir, img_width, img_height):
+# columns of the per-file scores.csv written by score_labeled_data
+SCORE_FIELDS = ["filename", "num_true", "num_pred", "num_tps", "precision", "recall", "f1_score",
+                "mean precision", "std precision", "mean recall", "std recall"]
+
+def score_file_pair(ground_truth_fpath, convnet_fpath, img_width, img_height, assignment='greedy'):
+    """Scores the convnet ROIs in an .npz file against the ground-truth ROI zip of the same stack.
+    Returns a dict with ROI counts, precision, recall and F1 score as in Score
+    and "overlap_bq" as in Score.overlap_bqs"""
+    ground_truth = GroundTruthIndex([load.load_rois(ground_truth_fpath, img_width, img_height, compact=True)])
+    predictions, matches = ground_truth.match([load.load_roi_npz(convnet_fpath)], assignment)
+    pairs, qualities = matches[0]
+    num_true, num_pred, num_tps = ground_truth.actual[0].shape[0], predictions[0].shape[0], len(pairs)
+    precision, recall = precision_recall(num_tps, num_pred, num_true)
+    overlap_bqs, _ = overlap_boundary_quality([{"tp_qualities":qualities}])
+    return {"num_true":num_true, "num_pred":num_pred, "num_tps":num_tps,
+            "precision":float(precision), "recall":float(recall), "f1_score":float(f1_score(precision, recall)),
+            "overlap_bq":overlap_bqs[0]}
+
+def labeled_file_pairs(ground_truth_dir, convnet_dir):
+    """Pairs ground-truth ROI zips in ground_truth_dir with convnet .npz files
+    in convnet_dir by file name. Returns sorted (filename, zip path, npz path)
+    tuples and prints files that cannot be paired"""
+    ground_truth = dict((os.path.basename(f).rsplit(".")[0], ground_truth_dir + f)
+                        for f in os.listdir(ground_truth_dir) if f.endswith('.zip'))
+    convnet = dict((os.path.splitext(os.path.basename(f))[0], convnet_dir + f)
+                   for f in os.listdir(convnet_dir) if f.endswith('.npz'))
+    pairs = []
+    for f in sorted(set(ground_truth) | set(convnet)):
+        if f not in ground_truth:
+            print "Unable to score " + f + " : missing ground truth data"
+        elif f not in convnet:
+            print "Unable to score " + f + " : missing convnet data"
+        else:
+            pairs.append((f, ground_truth[f], convnet[f]))
+    return pairs
+
+def score_labeled_data(postprocess_dir, data_dir, img_width, img_height, assignment='greedy', num_workers=1):
+    """Scores each labeled split one file pair at a time with num_workers processes.
+    Writes the scores of every file to scores.csv as they finish, then
+    score.txt with the Score of the whole split"""
     categories = ["training/", "validation/", "test/"]
     for c in categories:
-        ground_truth_rois, filenames = load.load_data(data_dir + c, img_width, img_height, rois_only=True)
-        rois = defaultdict(lambda: [None, None])
-        for i,r in enumerate(ground_truth_rois):
-            rois[filenames[i]][0] = r
-        for f in os.listdir(postprocess_dir + c):
-            filename = os.path.splitext(os.path.basename(f))[0]
-            if f.endswith('.npz'):
-                rois[filename][1] = np.load(postprocess_dir + c + f)['rois']
-        files_to_remove = []
-        for f in rois:
-            if rois[f][0] is None:
-                print "Unable to score " + f + " : missing ground truth data"
-                files_to_remove.append(f)
-            elif rois[f][1] is None:
-                print "Unable to score " + f + " : missing convnet data"
-                files_to_remove.append(f)
-        for f in files_to_remove:
-            rois.pop(f)
-        ground_truth_rois, convnet_rois = zip(*rois.values())
-        score = Score(ground_truth_rois, convnet_rois)
+        pairs = labeled_file_pairs(data_dir + c, postprocess_dir + c)
+        tasks = [(ground_truth_fpath, convnet_fpath, img_width, img_height, assignment)
+                 for f, ground_truth_fpath, convnet_fpath in pairs]
+        score = StreamingScore()
+        with open(postprocess_dir + c + "scores.csv", 'wb') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(SCORE_FIELDS)
+            results = map_tasks(score_file_pair, tasks, num_workers,
+                                initializer=load.set_roi_cache, initargs=load.roi_cache_settings())
+            for (f, _, _), (result, error) in izip(pairs, results):
+                if error is not None:
+                    print "Unable to score " + f + " :\n" + error
+                    continue
+                score.add(f, result)
+                row = dict(result)
+                row.update(result["overlap_bq"])
+                row["filename"] = f
+                writer.writerow([row[field] for field in SCORE_FIELDS])
+                csv_file.flush()
+        score.update_totals()
         with open(postprocess_dir + c + "score.txt", 'w') as score_file:
             score_file.write(str(score))
             
 
-def main(main_config_fpath='../data/example/main_config.cfg'):
+def main(main_config_fpath='../data/example/main_config.cfg', num_workers=None):
+    """Scores postprocessed labeled data with num_workers processes,
+    read from main_config.cfg if None"""
     cfg_parser = ConfigParser.SafeConfigParser()
     cfg_parser.readfp(open(main_config_fpath,'r'))
     
@@ -199,6 +454,12 @@ def main(main_config_fpath='../data/example/main_config.cfg'):
     postprocess_dir = data_dir[0:-1] + "_postprocessed" + os.sep
     img_width = cfg_parser.getint('general', 'img_width')
     img_height = cfg_parser.getint('general', 'img_height')
+    load.configure_roi_cache(cfg_parser)
+    assignment = 'greedy'
+    if cfg_parser.has_option('scoring', 'assignment'):
+        assignment = cfg_parser.get('scoring', 'assignment').strip()
+    if num_workers is None:
+        num_workers = get_num_workers(cfg_parser, 'scoring')
     # if not is_labeled(data_dir) or not is_labeled(postprocess_dir): #we haven't been putting test/train/val into a "labeled" folder #Let's discuss if we should. -AR 09/13/16
 
     if not is_labeled(data_dir):
@@ -210,7 +471,12 @@ def main(main_config_fpath='../data/example/main_config.cfg'):
             postprocess_dir += os.path.sep
         if data_dir[-1] != os.path.sep:
             data_dir += os.path.sep
-        score_labeled_data(postprocess_dir, data_dir, img_width, img_height)
+        score_labeled_data(postprocess_dir, data_dir, img_width, img_height, assignment, num_workers)
 
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 2:
+        main(sys.argv[1], int(sys.argv[2]))
+    elif len(sys.argv) > 1:
+        main(sys.argv[1])
+    else:
+        main()
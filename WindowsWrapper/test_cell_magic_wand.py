@@ -0,0 +1,30 @@
+###########################################################
+#
+# Regression tests for cell_magic_wand
+#
+# Usage: python -m unittest test_cell_magic_wand
+#
+###########################################################
+
+import unittest
+import numpy as np
+from cell_magic_wand import cell_magic_wand_batch, cell_magic_wand_single_point, uncrop_mask
+
+
+class BorderSeedTest(unittest.TestCase):
+    '''Seeds next to the image border with fractional max_radius'''
+
+    def setUp(self):
+        self.image = np.random.RandomState(0).rand(64, 64)
+
+    def test_float_radius_near_border(self):
+        for center, max_radius in [((57, 30), 7.3), ((57, 30), 7.6), ((56, 30), 8.5),
+                                   ((30, 57), 7.3), ((6, 30), 7.6), ((30, 6), 8.5)]:
+            masks, corners = cell_magic_wand_batch(self.image, [center], 5, max_radius)
+            mask = uncrop_mask(masks[0], corners[0], self.image.shape)
+            single, edge = cell_magic_wand_single_point(self.image, center, 5, max_radius)
+            self.assertTrue(np.array_equal(mask, single), (center, max_radius))
+
+
+if __name__ == '__main__':
+    unittest.main()
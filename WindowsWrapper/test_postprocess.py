@@ -0,0 +1,105 @@
+###########################################################
+#
+# Regression tests for postprocess
+#
+# Usage: python -m unittest test_postprocess
+#
+###########################################################
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import zipfile
+import ConfigParser
+import StringIO
+import numpy as np
+import tifffile
+import load
+from postprocess import parameter_optimization
+
+IMG_SIZE = 64
+NET_CROP = 4
+OPTIMIZATION_CFG = '''[postprocessing optimization]
+min_threshold = 0.3
+max_threshold = 0.8
+steps_threshold = 2
+min_minsize = 3
+max_minsize = 20
+steps_minsize = 2
+min_footprint = 5
+max_footprint = 9
+steps_footprint = 2
+steps_wand = 4
+search = %s
+search_budget = 12
+search_seed = %d
+'''
+
+
+def polygon_roi(xs, ys):
+    '''ImageJ polygon ROI file contents with integer vertices xs, ys'''
+    top, left, bottom, right = min(ys), min(xs), max(ys) + 1, max(xs) + 1
+    header = struct.pack('>4shBBhhhhH', 'Iout', 227, 0, 0, top, left, bottom, right, len(xs))
+    header += struct.pack('>ffffHIIIHHBBHII', 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+    return (header + struct.pack('>%dh' % len(xs), *[x - left for x in xs]) +
+            struct.pack('>%dh' % len(ys), *[y - top for y in ys]))
+
+
+class BorderSearchTest(unittest.TestCase):
+    '''Parameter searches on images with cells next to the image border'''
+
+    def setUp(self):
+        self.cache_max_mb = load.ROI_CACHE_MAX_MB
+        load.ROI_CACHE_MAX_MB = 0
+        self.root = tempfile.mkdtemp() + os.sep
+        for d in ['labeled', 'preprocessed', 'network', 'postprocessed']:
+            os.makedirs(self.root + d)
+        rng = np.random.RandomState(0)
+        x, y = np.mgrid[:IMG_SIZE, :IMG_SIZE]
+        for k in range(2):
+            image = rng.rand(IMG_SIZE, IMG_SIZE).astype(np.float32) * 0.1
+            network = np.zeros((IMG_SIZE, IMG_SIZE), dtype=np.float32)
+            roi_zip = zipfile.ZipFile(self.root + 'labeled/img%d.zip' % k, 'w')
+            # cells whose seeds plus a fractional wand radius reach just past the border
+            centers = [(59, 8), (58, 20), (57, 32), (56, 44), (55, 56), (8, 59), (30, 30)]
+            for c, (cx, cy) in enumerate(centers):
+                r = 3
+                disk = (x - cx)**2 + (y - cy)**2 <= r * r
+                image[disk] += 1.0
+                network[disk] = 0.9
+                phase = np.linspace(0, 2*np.pi, 13)[:-1]
+                roi_zip.writestr('%d.roi' % c, polygon_roi([int(round(cy + r*np.sin(a))) for a in phase],
+                                                           [int(round(cx + r*np.cos(a))) for a in phase]))
+            roi_zip.close()
+            tifffile.imsave(self.root + 'preprocessed/img%d.tif' % k, np.array([image] * 3))
+            tifffile.imsave(self.root + 'network/img%d_output_0.tif' % k,
+                            network[NET_CROP:-NET_CROP, NET_CROP:-NET_CROP])
+
+    def tearDown(self):
+        load.ROI_CACHE_MAX_MB = self.cache_max_mb
+        shutil.rmtree(self.root)
+
+    def optimize(self, search, seed=0):
+        cfg_parser = ConfigParser.SafeConfigParser()
+        cfg_parser.readfp(StringIO.StringIO(OPTIMIZATION_CFG % (search, seed)))
+        return parameter_optimization(self.root + 'labeled/', self.root + 'preprocessed/',
+                                      self.root + 'network/', self.root + 'postprocessed/',
+                                      2, 10, IMG_SIZE, IMG_SIZE, self.root + 'params.cfg',
+                                      cfg_parser, num_workers=1)
+
+    def test_random_search_wand_radius(self):
+        for seed in range(3):
+            params = self.optimize('random', seed)
+            max_size_wand = params.getfloat('postprocessing', 'max_size_wand')
+            self.assertEqual(max_size_wand, round(max_size_wand))
+
+    def test_exhaustive_search_wand_radius(self):
+        params = self.optimize('exhaustive')
+        max_size_wand = params.getfloat('postprocessing', 'max_size_wand')
+        self.assertEqual(max_size_wand, round(max_size_wand))
+
+
+if __name__ == '__main__':
+    unittest.main()
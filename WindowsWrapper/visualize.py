@@ -23,7 +23,7 @@ from collections import defaultdict
 import numpy as np
 import ConfigParser
 from preprocess import add_pathsep, is_labeled
-from load import load_stack, load_rois
+from load import open_stack, load_rois, load_roi_npz, configure_roi_cache
 
 
 class App:
@@ -35,6 +35,7 @@ class App:
         self.files = files
         self.img_width, self.img_height = img_width, img_height
         self.gt_labels = False
+        self.image = None
         self.manual_thresh = StringVar()
         self.just_set_thresh = False
         self.manual_thresh.trace("w", self.manual_thresh_change)
@@ -89,12 +90,14 @@ class App:
         '''load a new image and corresponding ROIs'''
         current_files = self.files[self.files_keys[self.current_index]]
         self.filename_label.config(text=self.files_keys[self.current_index])
-        self.image = load_stack(current_files[0])
+        if self.image is not None:
+            self.image.close()
+        self.image = open_stack(current_files[0])
         self.image_slider.config(to=self.image.shape[0]-1)
         self.image_slider.set(0)
         self.image_index = 0
         
-        self.convnet_rois = np.load(current_files[1])['rois']
+        self.convnet_rois = load_roi_npz(current_files[1])
         self.convnet_roi_probs = np.load(current_files[1])['roi_probabilities']
         self.indexed_roi_probs = sorted([(v,i) for i,v in enumerate(self.convnet_roi_probs)], reverse=True)
         assert(self.convnet_rois.shape[0] == self.convnet_roi_probs.shape[0])
@@ -114,8 +117,8 @@ class App:
             self.roi_slider.set(new_index)
                         
         if current_files[2] is not None:
-            self.gt_rois = load_rois(current_files[2], self.img_width, self.img_height)
-            self.gt_rois = self.gt_rois.max(axis=0)
+            self.gt_rois = load_rois(current_files[2], self.img_width, self.img_height, compact=True)
+            self.gt_rois = self.gt_rois.max_projection()
 
         self.draw_canvas()
 
@@ -124,15 +127,16 @@ class App:
         '''draw current image and selected ROIs'''
         self.f.clf()
         overlay = np.zeros((self.image.shape[1], self.image.shape[2], 3))
-        overlay[:,:,0] = self.image[self.image_index,:,:]
-        overlay[:,:,1] = self.image[self.image_index,:,:]
-        overlay[:,:,2] = self.image[self.image_index,:,:]
+        frame = self.image[self.image_index]
+        overlay[:,:,0] = frame
+        overlay[:,:,1] = frame
+        overlay[:,:,2] = frame
 
         current_roi_indices = [i for (v,i) in self.indexed_roi_probs[0:self.roi_index]]
         if len(current_roi_indices) > 0:
             cutoff = self.indexed_roi_probs[self.roi_index-1][0]
             self.max_thresh_value_label.config(text=">= {:.3f}".format(cutoff))
-            current_rois_mask = self.convnet_rois[current_roi_indices].max(axis=0)
+            current_rois_mask = self.convnet_rois[current_roi_indices].max_projection()
             overlay[:,:,2][current_rois_mask == 1] = 1    
         else:
             cutoff = self.indexed_roi_probs[0][0]
@@ -166,7 +170,7 @@ class App:
         current_rois = self.convnet_rois[current_roi_indices]
         current_files = self.files[self.files_keys[self.current_index]]
         new_file = current_files[1][0:-4] + "_MANUAL.npz"
-        np.savez_compressed(new_file, rois=current_rois)
+        current_rois.save(new_file)
         print "saved as " + new_file
 
         
@@ -250,6 +254,7 @@ def main(main_config_fpath="../data/example/main_config.cfg"):
                 
     img_width = cfg_parser.getint('general','img_width')
     img_height = cfg_parser.getint('general', 'img_height')
+    configure_roi_cache(cfg_parser)
                        
     root = Tk()
     root.wm_title("ConvnetCellDetection")
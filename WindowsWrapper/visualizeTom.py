@@ -25,7 +25,7 @@ from collections import defaultdict
 import numpy as np
 import ConfigParser
 from preprocess import add_pathsep, is_labeled
-from load import load_stack, load_rois
+from load import load_stack, load_rois, load_roi_npz
 from skimage import io
 
 
@@ -42,7 +42,7 @@ class App:
         self.manual_thresh.trace("w", self.manual_thresh_change)
         self.image = self.getIm()
         #self.image = load_stack(self.fname)
-        self.convnet_rois = np.load(self.rname)['rois']
+        self.convnet_rois = load_roi_npz(self.rname).dense()
         self.convnet_roi_probs = np.load(self.rname)['roi_probabilities']
         self.roi_index = self.convnet_rois.shape[0]
         self.indexed_roi_probs = sorted([(v,i) for i,v in enumerate(self.convnet_roi_probs)], reverse=True)